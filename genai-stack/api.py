@@ -1,101 +1,242 @@
 import os
 
-from langchain_neo4j import Neo4jGraph
 from dotenv import load_dotenv
 from utils import (
-    create_vector_index,
+    build_context,
+    get_data_version,
+    normalize_question,
+    SemanticCache,
     BaseLogger,
+    TicketStreamParser,
 )
 from chains import (
-    load_embedding_model,
-    load_llm,
-    configure_llm_only_chain,
-    configure_qa_rag_chain,
+    RETRIEVAL_OPTIONS,
+    SHALLOW_RETRIEVAL,
     generate_ticket,
+    get_registry,
+    search_stackoverflow,
 )
-from fastapi import FastAPI, Depends
-from pydantic import BaseModel
-from langchain.callbacks.base import BaseCallbackHandler
-from threading import Thread
-from queue import Queue, Empty
+from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
 from collections.abc import Generator
 from sse_starlette.sse import EventSourceResponse
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 import json
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv(".env")
 
 url = os.getenv("NEO4J_URI")
-username = os.getenv("NEO4J_USERNAME")
-password = os.getenv("NEO4J_PASSWORD")
-ollama_base_url = os.getenv("OLLAMA_BASE_URL")
-embedding_model_name = os.getenv("EMBEDDING_MODEL")
 llm_name = os.getenv("LLM")
+answer_cache_size = int(os.getenv("ANSWER_CACHE_SIZE", "0"))
+answer_cache_ttl = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+answer_cache_similarity = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+max_concurrent_streams = int(os.getenv("MAX_CONCURRENT_STREAMS", "100"))
+max_concurrent_queries = int(os.getenv("MAX_CONCURRENT_QUERIES", "32"))
+max_concurrent_tickets = int(os.getenv("MAX_CONCURRENT_TICKETS", "8"))
+queue_timeout = float(os.getenv("QUEUE_TIMEOUT", "30"))
+max_batch_size = int(os.getenv("MAX_BATCH_SIZE", "5000"))
+max_batch_concurrency = int(os.getenv("MAX_BATCH_CONCURRENCY", "16"))
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+warm_up = os.getenv("WARM_UP", "false").lower() == "true"
+query_routing = os.getenv("QUERY_ROUTING", "false").lower() == "true"
+# Server-side caps of the per-request retrieval settings
+max_retrieval_k = int(os.getenv("MAX_RETRIEVAL_K", "20"))
+max_answers_per_question = int(os.getenv("MAX_ANSWERS_PER_QUESTION", "10"))
+context_tokens_limit = int(os.getenv("CONTEXT_TOKENS_LIMIT", "2500"))
 # Remapping for Langchain Neo4j integration
 os.environ["NEO4J_URL"] = url
 
-embeddings, dimension = load_embedding_model(
-    embedding_model_name,
-    config={"ollama_base_url": ollama_base_url},
-    logger=BaseLogger(),
-)
+# Models, the graph and chains are built on first use
+registry = get_registry(logger=BaseLogger())
 
-# if Neo4j is local, you can go to http://localhost:7474/ to browse the database
-neo4j_graph = Neo4jGraph(
-    url=url, username=username, password=password, refresh_schema=False
+# Final answers per mode ("rag:vector" / "rag:hybrid" / "llm"), matched by question similarity
+answer_cache = SemanticCache(
+    max_size=answer_cache_size,
+    ttl=answer_cache_ttl,
+    similarity_threshold=answer_cache_similarity,
+    embed=lambda text: registry.embeddings().embed_query(text),
+    version=lambda: get_data_version(registry.neo4j_graph()),
 )
-create_vector_index(neo4j_graph)
 
-llm = load_llm(
-    llm_name, logger=BaseLogger(), config={"ollama_base_url": ollama_base_url}
-)
 
-llm_chain = configure_llm_only_chain(llm)
-rag_chain = configure_qa_rag_chain(
-    llm, embeddings, embeddings_store_url=url, username=username, password=password
-)
+class ConcurrencyLimit:
+    """Caps the requests an endpoint works on at once.
 
+    Requests over the limit wait for a slot; after `timeout` seconds of
+    waiting they are rejected with 503 instead of piling up.
+    """
 
-class QueueCallback(BaseCallbackHandler):
-    """Callback handler for streaming LLM responses to a queue."""
+    def __init__(self, limit: int, timeout: float):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.timeout = timeout
 
-    def __init__(self, q):
-        self.q = q
+    async def __aenter__(self):
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Server busy, retry later")
 
-    def on_llm_new_token(self, token: str, **kwargs) -> None:
-        self.q.put(token)
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
 
-    def on_llm_end(self, *args, **kwargs) -> None:
-        return self.q.empty()
 
+query_limit = ConcurrencyLimit(max_concurrent_queries, queue_timeout)
+ticket_limit = ConcurrencyLimit(max_concurrent_tickets, queue_timeout)
+# generate_ticket has no async variant, so it runs on its own bounded pool
+ticket_executor = ThreadPoolExecutor(max_workers=max_concurrent_tickets)
 
-def stream(cb, q) -> Generator:
-    job_done = object()
 
-    def task():
-        x = cb()
-        q.put(job_done)
+class TokenBroadcast:
+    """Fans the token stream of one generation out to any number of subscribers.
 
-    t = Thread(target=task)
-    t.start()
+    Subscribers joining late first receive the tokens produced so far. The
+    generation is cancelled once every subscriber has gone away. `on_done` is
+    called with the broadcast when it ends; `complete` tells whether the whole
+    stream was produced without error or cancellation.
+    """
 
-    content = ""
+    def __init__(self, tokens, on_done=None):
+        self.tokens = []
+        self.done = False
+        self.complete = False
+        self.error = None
+        self.subscribers = 0
+        self._on_done = on_done
+        self._changed = asyncio.Condition()
+        self._task = asyncio.ensure_future(self._produce(tokens))
 
-    # Get each new token from the queue and yield for our generator
-    while True:
+    async def _produce(self, tokens):
+        try:
+            async for token in tokens:
+                async with self._changed:
+                    self.tokens.append(token)
+                    self._changed.notify_all()
+            self.complete = True
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self._changed:
+                self.done = True
+                self._changed.notify_all()
+            if self._on_done:
+                self._on_done(self)
+
+    async def subscribe(self):
+        self.subscribers += 1
         try:
-            next_token = q.get(True, timeout=1)
-            if next_token is job_done:
-                break
-            content += next_token
-            yield next_token, content
-        except Empty:
-            continue
+            sent = 0
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(
+                        lambda: sent < len(self.tokens) or self.done
+                    )
+                    new_tokens = self.tokens[sent:]
+                    finished = self.done
+                for token in new_tokens:
+                    yield token
+                sent += len(new_tokens)
+                if finished:
+                    if self.error:
+                        raise self.error
+                    return
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self._task.cancel()
+
+
+# Identical questions asked while an answer is being generated share that
+# generation instead of starting their own, keyed by (mode, normalized text)
+inflight_answers = {}
+inflight_streams = {}
+
+
+async def limited_stream(tokens):
+    async with stream_slots:
+        async for token in tokens:
+            yield token
+
+
+async def get_chain(rag: bool, retrieval: str = "vector"):
+    # The first call builds the chain and its models, so keep it off the event loop
+    if rag:
+        return await run_in_threadpool(registry.rag_chain, retrieval)
+    return await run_in_threadpool(registry.llm_chain)
+
+
+def answer_mode(rag: bool, retrieval: str, config: dict) -> str:
+    # Cache namespace and coalescing key; RAG answers differ per retrieval settings
+    if not rag:
+        return "llm"
+    return ":".join(
+        ["rag", retrieval]
+        + [
+            f"{key}={value}"
+            for key, value in sorted(config["configurable"].items())
+            if key in RETRIEVAL_OPTIONS
+        ]
+    )
+
+
+async def plan_answer(question) -> tuple:
+    """Picks the chain, its config and the answer mode of a question.
+
+    Routed RAG questions may be answered with a shallow retrieval or by the
+    LLM alone; explicitly requested retrieval settings still apply. Returns
+    the route decision too, None when the question was not routed.
+    """
+    rag = question.rag
+    config = question.retrieval_config()
+    decision = None
+    if rag and (query_routing if question.route is None else question.route):
+        router = await run_in_threadpool(registry.query_router)
+
+        def route():
+            vector = router.embeddings.embed_query(question.text)
+            return router.route(question.text, vector), vector
+
+        decision, vector = await run_in_threadpool(route)
+        if decision["route"] == "llm":
+            rag = False
+        else:
+            if decision["route"] == "shallow":
+                config = {
+                    "configurable": {**SHALLOW_RETRIEVAL, **config["configurable"]}
+                }
+            # The retrieval reuses the embedding the router computed
+            config["configurable"]["vector"] = vector
+    output_function = await get_chain(rag, question.retrieval)
+    return (
+        output_function,
+        config,
+        answer_mode(rag, question.retrieval, config),
+        decision,
+    )
+
+
+def replay(answer: str) -> Generator:
+    # Split a cached answer into word-sized tokens so it streams like a fresh one
+    for token in re.findall(r"\s*\S+", answer):
+        yield token
 
 
 app = FastAPI()
 origins = ["*"]
 
+
+@app.on_event("startup")
+async def start_warm_up():
+    # Build models in the background so the worker starts serving immediately
+    if warm_up:
+        asyncio.get_running_loop().run_in_executor(None, registry.warm_up)
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -110,49 +251,266 @@ async def root():
     return {"message": "Hello World"}
 
 
-class Question(BaseModel):
+class RetrievalSettings(BaseModel):
+    # Unset fields keep the RAG chain defaults
+    retrieval: Literal["vector", "hybrid"] = "vector"
+    k: Optional[int] = Field(default=None, ge=1, le=max_retrieval_k)
+    answers_per_question: Optional[int] = Field(
+        default=None, ge=1, le=max_answers_per_question
+    )
+    score_threshold: Optional[float] = Field(default=None, ge=0, le=1)
+    max_context_tokens: Optional[int] = Field(
+        default=None, ge=100, le=context_tokens_limit
+    )
+    # Cross-encoder re-ranking, on by default when RERANK_MODEL is set
+    rerank: Optional[bool] = None
+
+    def retrieval_config(self) -> dict:
+        return {
+            "configurable": self.model_dump(
+                include=set(RETRIEVAL_OPTIONS), exclude_none=True
+            )
+        }
+
+
+class Question(RetrievalSettings):
     text: str
     rag: bool = False
+    # Let the query router pick full RAG, a shallow retrieval or the LLM alone
+    route: Optional[bool] = None
 
 
 class BaseTicket(BaseModel):
     text: str
 
 
-@app.get("/query-stream")
-def qstream(question: Question = Depends()):
-    output_function = llm_chain
-    if question.rag:
-        output_function = rag_chain
+class QuestionBatch(RetrievalSettings):
+    questions: List[str] = Field(min_length=1, max_length=max_batch_size)
+    rag: bool = False
+    max_concurrency: int = Field(default=4, ge=1, le=max_batch_concurrency)
+    stream: bool = False
 
-    q = Queue()
 
-    def cb():
-        output_function.invoke(question.text, config={"callbacks": [QueueCallback(q)]})
+# Open streams beyond this limit wait for a slot instead of hitting the LLM at once
+stream_slots = asyncio.Semaphore(max_concurrent_streams)
 
-    def generate():
-        yield json.dumps({"init": True, "model": llm_name})
-        for token, _ in stream(cb, q):
-            yield json.dumps({"token": token})
+
+@app.get("/query-stream")
+async def qstream(request: Request, question: Question = Depends()):
+    output_function, config, mode, decision = await plan_answer(question)
+    key = (mode, normalize_question(question.text))
+
+    async def generate():
+        cached, embedding = await run_in_threadpool(
+            answer_cache.lookup, question.text, namespace=mode
+        )
+        yield json.dumps(
+            {
+                "init": True,
+                "model": llm_name,
+                "cached": cached is not None,
+                "route": decision,
+            }
+        )
+        if cached is not None:
+            for token in replay(cached):
+                yield json.dumps({"token": token})
+            return
+        broadcast = inflight_streams.get(key)
+        if broadcast is None:
+
+            def finished(broadcast):
+                inflight_streams.pop(key, None)
+                # Cached by the generation itself, whichever clients are still
+                # listening, and only once the answer is whole
+                if broadcast.complete:
+                    asyncio.get_running_loop().run_in_executor(
+                        None,
+                        answer_cache.put,
+                        question.text,
+                        "".join(broadcast.tokens),
+                        embedding,
+                        mode,
+                    )
+
+            broadcast = TokenBroadcast(
+                limited_stream(output_function.astream(question.text, config=config)),
+                on_done=finished,
+            )
+            inflight_streams[key] = broadcast
+        tokens = broadcast.subscribe()
+        try:
+            async for token in tokens:
+                # Stop listening as soon as the client goes away
+                if await request.is_disconnected():
+                    return
+                yield json.dumps({"token": token})
+        finally:
+            await tokens.aclose()
 
     return EventSourceResponse(generate(), media_type="text/event-stream")
 
 
 @app.get("/query")
 async def ask(question: Question = Depends()):
-    output_function = llm_chain
-    if question.rag:
-        output_function = rag_chain
-    result = output_function.invoke(question.text)
+    output_function, config, mode, decision = await plan_answer(question)
+    key = (mode, normalize_question(question.text))
+
+    async def answer():
+        async with query_limit:
+            result, embedding = await run_in_threadpool(
+                answer_cache.lookup, question.text, namespace=mode
+            )
+            if result is not None:
+                return result, True
+            result = await output_function.ainvoke(question.text, config=config)
+            await run_in_threadpool(
+                answer_cache.put, question.text, result, embedding, namespace=mode
+            )
+            return result, False
+
+    task = inflight_answers.get(key)
+    if task is None:
+        task = asyncio.ensure_future(answer())
+        inflight_answers[key] = task
+        task.add_done_callback(lambda _: inflight_answers.pop(key, None))
+    # Shielded so one client disconnecting does not cancel the others' answer
+    result, cached = await asyncio.shield(task)
+
+    return {"result": result, "model": llm_name, "cached": cached, "route": decision}
+
+
+@app.post("/query-batch")
+async def query_batch(batch: QuestionBatch):
+    if batch.rag:
+        options = batch.retrieval_config()["configurable"]
+        max_context_tokens = options.pop(
+            "max_context_tokens", registry.config["max_context_tokens"]
+        )
+        if options.pop("rerank", True):
+            options.update(await run_in_threadpool(registry.reranking))
+        embeddings = await run_in_threadpool(registry.embeddings)
+        vector_store = await run_in_threadpool(registry.stackoverflow_store)
+        output_function = await run_in_threadpool(registry.qa_answer_chain)
+        count_tokens = await run_in_threadpool(registry.token_counter)
+        # The questions are embedded EMBEDDING_BATCH_SIZE at a time, one
+        # embed_documents call per chunk, started by its first question
+        chunks = {}
+
+        async def embed(index):
+            start = index - index % embedding_batch_size
+            if start not in chunks:
+                chunks[start] = asyncio.ensure_future(
+                    run_in_threadpool(
+                        embeddings.embed_documents,
+                        batch.questions[start : start + embedding_batch_size],
+                    )
+                )
+            # Shielded so a cancelled question does not cancel its chunk
+            return (await asyncio.shield(chunks[start]))[index - start]
+
+        def prepare(question, vector):
+            docs = search_stackoverflow(
+                vector_store, question, batch.retrieval, vector=vector, **options
+            )
+            return {
+                "summaries": build_context(docs, max_context_tokens, count_tokens)[0],
+                "question": question,
+            }
+
+    else:
+        output_function = await get_chain(False)
+        prepare = None
+
+    slots = asyncio.Semaphore(batch.max_concurrency)
+
+    async def answer(index, question):
+        # Each question is retrieved and answered on its own, so its result is
+        # ready without waiting for the rest of the batch
+        async with slots:
+            line = {"index": index, "question": question}
+            try:
+                input = question
+                if prepare:
+                    vector = await embed(index)
+                    input = await run_in_threadpool(prepare, question, vector)
+                # Batch generations share the limit of the other endpoints
+                async with query_limit:
+                    line["result"] = await output_function.ainvoke(input)
+            except Exception as e:
+                line["error"] = str(e)
+            return line
+
+    if not batch.stream:
+        lines = await asyncio.gather(
+            *(answer(i, q) for i, q in enumerate(batch.questions))
+        )
+        for line in lines:
+            del line["index"]
+        return {"results": lines, "model": llm_name}
+
+    # NDJSON, one line per question in order of completion
+    async def generate():
+        tasks = [
+            asyncio.ensure_future(answer(i, q)) for i, q in enumerate(batch.questions)
+        ]
+        try:
+            for next_line in asyncio.as_completed(tasks):
+                yield json.dumps(await next_line) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
-    return {"result": result["answer"], "model": llm_name}
+
+@app.get("/cache-stats")
+async def cache_stats():
+    embeddings = await run_in_threadpool(registry.embeddings)
+    stats = {
+        "answers": answer_cache.stats(),
+        "retrieval": registry.retrieval_cache().stats(),
+    }
+    if hasattr(embeddings, "stats"):
+        stats["embeddings"] = embeddings.stats()
+    return stats
 
 
 @app.get("/generate-ticket")
 async def generate_ticket_api(question: BaseTicket = Depends()):
-    new_title, new_question = generate_ticket(
-        neo4j_graph=neo4j_graph,
-        llm_chain=llm_chain,
-        input_question=question.text,
-    )
+    async with ticket_limit:
+        new_title, new_question = await asyncio.get_running_loop().run_in_executor(
+            ticket_executor,
+            lambda: generate_ticket(
+                ticket_chain=registry.ticket_chain(),
+                input_question=question.text,
+            ),
+        )
     return {"result": {"title": new_title, "text": new_question}, "model": llm_name}
+
+
+@app.get("/generate-ticket-stream")
+async def generate_ticket_stream_api(
+    request: Request, question: BaseTicket = Depends()
+):
+    ticket_chain = await run_in_threadpool(registry.ticket_chain)
+
+    async def generate():
+        try:
+            async with ticket_limit:
+                yield json.dumps({"init": True, "model": llm_name})
+                # Each field is pushed as soon as its first words are generated
+                parser = TicketStreamParser()
+                async for chunk in ticket_chain.astream(question.text):
+                    if await request.is_disconnected():
+                        return
+                    for field, text in parser.feed(chunk):
+                        yield json.dumps({field: text})
+                new_title, new_question = parser.result()
+                yield json.dumps(
+                    {"done": True, "title": new_title, "text": new_question}
+                )
+        except HTTPException as e:
+            yield json.dumps({"error": e.detail})
+
+    return EventSourceResponse(generate(), media_type="text/event-stream")
@@ -3,40 +3,30 @@ import os
 import streamlit as st
 from streamlit.logger import get_logger
 from langchain.callbacks.base import BaseCallbackHandler
-from langchain_neo4j import Neo4jGraph
 from dotenv import load_dotenv
-from utils import (
-    create_vector_index,
-)
 from chains import (
-    load_embedding_model,
-    load_llm,
-    configure_llm_only_chain,
-    configure_qa_rag_chain,
-    generate_ticket,
+    ChainRegistry,
+    config_from_env,
 )
+from utils import TicketStreamParser
 
 load_dotenv(".env")
 
 url = os.getenv("NEO4J_URI")
-username = os.getenv("NEO4J_USERNAME")
-password = os.getenv("NEO4J_PASSWORD")
-ollama_base_url = os.getenv("OLLAMA_BASE_URL")
-embedding_model_name = os.getenv("EMBEDDING_MODEL")
-llm_name = os.getenv("LLM")
 # Remapping for Langchain Neo4j integration
 os.environ["NEO4J_URL"] = url
 
 logger = get_logger(__name__)
 
-# if Neo4j is local, you can go to http://localhost:7474/ to browse the database
-neo4j_graph = Neo4jGraph(
-    url=url, username=username, password=password, refresh_schema=False
-)
-embeddings, dimension = load_embedding_model(
-    embedding_model_name, config={"ollama_base_url": ollama_base_url}, logger=logger
-)
-create_vector_index(neo4j_graph)
+
+# Shared by all sessions and reruns; a changed configuration replaces the
+# cached registry, whose models, graph and chains are built on first use
+@st.cache_resource(max_entries=1)
+def load_registry(config: tuple) -> ChainRegistry:
+    return ChainRegistry(dict(config), logger=logger)
+
+
+registry = load_registry(tuple(sorted(config_from_env().items())))
 
 
 class StreamHandler(BaseCallbackHandler):
@@ -49,13 +39,6 @@ class StreamHandler(BaseCallbackHandler):
         self.container.markdown(self.text)
 
 
-llm = load_llm(llm_name, logger=logger, config={"ollama_base_url": ollama_base_url})
-
-llm_chain = configure_llm_only_chain(llm)
-rag_chain = configure_qa_rag_chain(
-    llm, embeddings, embeddings_store_url=url, username=username, password=password
-)
-
 # Streamlit UI
 styl = f"""
 <style>
@@ -138,15 +121,18 @@ def display_chat():
 
 
 def mode_select() -> str:
-    options = ["Disabled", "Enabled"]
+    options = ["Disabled", "Enabled", "Hybrid"]
     return st.radio("Select RAG mode", options, horizontal=True)
 
 
 name = mode_select()
 if name == "LLM only" or name == "Disabled":
-    output_function = llm_chain
+    output_function = registry.llm_chain()
 elif name == "Vector + Graph" or name == "Enabled":
-    output_function = rag_chain
+    output_function = registry.rag_chain()
+elif name == "Hybrid":
+    # Vector + full-text search, fused by rank
+    output_function = registry.rag_chain("hybrid")
 
 
 def open_sidebar():
@@ -160,16 +146,28 @@ def close_sidebar():
 if not "open_sidebar" in st.session_state:
     st.session_state.open_sidebar = False
 if st.session_state.open_sidebar:
-    new_title, new_question = generate_ticket(
-        neo4j_graph=neo4j_graph,
-        llm_chain=llm_chain,
-        input_question=st.session_state[f"user_input"][-1],
-    )
+    # Draft once per question, not on every rerun while the sidebar is open
+    input_question = st.session_state[f"user_input"][-1]
+    draft = st.session_state.get("ticket_draft")
     with st.sidebar:
         st.title("Ticket draft")
         st.write("Auto generated draft ticket")
-        st.text_input("Title", new_title)
-        st.text_area("Description", new_question)
+        title_box = st.empty()
+        question_box = st.empty()
+        if draft is None or draft[0] != input_question:
+            # Show both fields while they are generated, editable once done
+            fields = {"title": "", "question": ""}
+            parser = TicketStreamParser()
+            for chunk in registry.ticket_chain().stream(input_question):
+                for field, text in parser.feed(chunk):
+                    fields[field] += text
+                    title_box.markdown(f"**{fields['title']}**")
+                    question_box.markdown(fields["question"])
+            draft = (input_question,) + parser.result()
+            st.session_state.ticket_draft = draft
+        _, new_title, new_question = draft
+        title_box.text_input("Title", new_title)
+        question_box.text_area("Description", new_question)
         st.button(
             "Submit to support team",
             type="primary",
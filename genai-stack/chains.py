@@ -7,9 +7,15 @@ from langchain_openai import ChatOpenAI
 from langchain_ollama import ChatOllama
 from langchain_aws import ChatBedrock
 
-from langchain_neo4j import Neo4jVector
+from langchain_neo4j import Neo4jGraph, Neo4jVector
 
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
+from langchain_core.runnables import (
+    RunnableLambda,
+    RunnableParallel,
+    RunnablePassthrough,
+)
+from langchain_core.documents import Document
+from langchain_core.messages import SystemMessage
 from langchain_core.output_parsers import StrOutputParser
 
 from langchain.prompts import (
@@ -18,8 +24,30 @@ from langchain.prompts import (
     SystemMessagePromptTemplate,
 )
 
+import hashlib
+import math
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
 from typing import List, Any
-from utils import BaseLogger, extract_title_and_question, format_docs
+from utils import (
+    BaseLogger,
+    SemanticCache,
+    build_context,
+    create_fulltext_index,
+    create_vector_index,
+    escape_lucene,
+    extract_title_and_question,
+    get_data_version,
+)
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
 AWS_MODELS = (
@@ -32,31 +60,332 @@ AWS_MODELS = (
 )
 
 
+class CachedEmbeddings(Embeddings):
+    """Persistent embedding cache keyed by (backend, model, kind, text hash).
+
+    Vectors are stored in a SQLite file so they survive restarts and can be
+    shared by the loader, bots and API; WAL mode lets their reads and writes
+    overlap. Query and document vectors are kept apart ("q" / "d"), since
+    some backends embed them differently.
+
+    The least recently used entries are evicted once more than `max_entries`
+    vectors are stored, checked every `evict_interval` stores. Cache hits
+    update the last use in memory, written out every `touch_interval`
+    seconds, so a hit costs no write.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        backend,
+        model,
+        path,
+        max_entries=500_000,
+        evict_interval=1000,
+        touch_interval=60,
+    ):
+        self.embeddings = embeddings
+        self.namespace = f"{backend}:{model}"
+        self.max_entries = max_entries
+        self.evict_interval = evict_interval
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._touched_at = time.monotonic()
+        self._stored = 0
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode this syncs at checkpoints only, not on every commit
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB, last_used REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+
+    def _key(self, text: str, kind: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{kind}:{digest}"
+
+    def _count(self, hits: int, misses: int) -> None:
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def _lookup(self, keys: List[str]) -> dict:
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                rows = self._conn.execute(
+                    "SELECT key, vector FROM embeddings WHERE key IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                ).fetchall()
+                found.update((key, array("d", blob).tolist()) for key, blob in rows)
+            now = time.time()
+            self._touched.update((key, now) for key in found)
+            if (
+                len(self._touched) >= self.evict_interval
+                or time.monotonic() - self._touched_at >= self.touch_interval
+            ):
+                self._write_touched()
+                self._conn.commit()
+        return found
+
+    def _write_touched(self) -> None:
+        # Called with the lock held; the caller commits
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(now, key) for key, now in self._touched.items()],
+            )
+            self._touched = {}
+        self._touched_at = time.monotonic()
+
+    def _store(self, entries: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [
+                    (key, array("d", vector).tobytes(), now)
+                    for key, vector in entries.items()
+                ],
+            )
+            self._stored += len(entries)
+            if self._stored >= self.evict_interval:
+                self._stored = 0
+                self._write_touched()
+                (count,) = self._conn.execute(
+                    "SELECT count(*) FROM embeddings"
+                ).fetchone()
+                if count > self.max_entries:
+                    self._conn.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+            self._conn.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text, "d") for text in texts]
+        cached = self._lookup(list(set(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        self._count(len(texts) - len(missing), len(missing))
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._store(computed)
+            cached.update(computed)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text, "q")
+        cached = self._lookup([key])
+        if key in cached:
+            self._count(1, 0)
+            return cached[key]
+        self._count(0, 1)
+        vector = self.embeddings.embed_query(text)
+        self._store({key: vector})
+        return vector
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+
+class QuantizedSentenceTransformerEmbeddings(Embeddings):
+    """A SentenceTransformer on the CPU with int8 dynamically quantized layers.
+
+    The weights of the transformer's linear layers are stored as int8 and
+    its activations quantized on the fly, which is where nearly all the
+    time goes; everything else stays fp32. The vectors keep the model's
+    dimension and stay close to the fp32 ones, so they work with the index
+    built by the default sentence_transformer backend.
+
+    `threads` is set with torch.set_num_threads, which applies to all of
+    torch in the process, not just this model.
+    """
+
+    def __init__(
+        self, model_name: str, cache_folder=None, batch_size: int = 64, threads=0
+    ):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            torch.set_num_threads(threads)
+        model = SentenceTransformer(model_name, device="cpu", cache_folder=cache_folder)
+        self.model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        self.batch_size = batch_size
+        self._torch = torch
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self._torch.inference_mode():
+            vectors = self.model.encode(
+                texts,
+                batch_size=self.batch_size,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+            )
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+# Backends running the model in-process, which EmbeddingWorkerPool can spread
+LOCAL_EMBEDDING_MODELS = ("sentence_transformer", "sentence_transformer_int8")
+
+# The model of an EmbeddingWorkerPool worker process
+_worker_embeddings = None
+
+
+def _init_embedding_worker(embedding_model_name: str, config: dict) -> None:
+    global _worker_embeddings
+    if config.get("local_threads"):
+        import torch
+
+        torch.set_num_threads(int(config["local_threads"]))
+    _worker_embeddings = load_embedding_model(embedding_model_name, config=config)[0]
+
+
+def _embed_in_worker(texts: List[str]):
+    # An array pickles as one buffer, unlike a list of lists of floats
+    return np.asarray(_worker_embeddings.embed_documents(texts), dtype=np.float32)
+
+
+class EmbeddingWorkerPool(Embeddings):
+    """Embeds with a local model loaded once in each of `workers` processes.
+
+    In-process, a local model embeds under the GIL and uses a single core for
+    everything but its matrix products. Here every call is split into chunks
+    of at least `min_chunk_size` texts that the workers embed in parallel,
+    and concurrent calls share the workers. Each worker gets an equal share of
+    the CPU threads unless `local_threads` is configured.
+    """
+
+    def __init__(
+        self,
+        embedding_model_name: str,
+        workers: int,
+        config: dict = {},
+        min_chunk_size: int = 8,
+    ):
+        config = {key: value for key, value in config.items() if key != "workers"}
+        if not config.get("local_threads"):
+            config["local_threads"] = max(1, (os.cpu_count() or 1) // workers)
+        self.workers = workers
+        self.min_chunk_size = min_chunk_size
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_embedding_worker,
+            initargs=(embedding_model_name, config),
+        )
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        size = max(self.min_chunk_size, math.ceil(len(texts) / self.workers))
+        chunks = [texts[i : i + size] for i in range(0, len(texts), size)]
+        return [
+            vector.tolist()
+            for vectors in self._executor.map(_embed_in_worker, chunks)
+            for vector in vectors
+        ]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+
 def load_embedding_model(embedding_model_name: str, logger=BaseLogger(), config={}):
     if embedding_model_name == "ollama":
-        embeddings = OllamaEmbeddings(
-            base_url=config["ollama_base_url"], model="llama2"
-        )
+        model = "llama2"
+        embeddings = OllamaEmbeddings(base_url=config["ollama_base_url"], model=model)
         dimension = 4096
         logger.info("Embedding: Using Ollama")
     elif embedding_model_name == "openai":
         embeddings = OpenAIEmbeddings()
+        model = embeddings.model
         dimension = 1536
         logger.info("Embedding: Using OpenAI")
     elif embedding_model_name == "aws":
         embeddings = BedrockEmbeddings()
+        model = embeddings.model_id
         dimension = 1536
         logger.info("Embedding: Using AWS")
     elif embedding_model_name == "google-genai-embedding-001":
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+        model = "models/embedding-001"
+        embeddings = GoogleGenerativeAIEmbeddings(model=model)
         dimension = 768
         logger.info("Embedding: Using Google Generative AI Embeddings")
+    elif (
+        embedding_model_name in LOCAL_EMBEDDING_MODELS
+        and int(config.get("workers") or 0) > 1
+    ):
+        workers = int(config["workers"])
+        model = "all-MiniLM-L6-v2"
+        embeddings = EmbeddingWorkerPool(
+            embedding_model_name,
+            workers,
+            config={
+                key: value
+                for key, value in config.items()
+                if key not in ("cache_path", "cache_max_entries")
+            },
+        )
+        dimension = 384
+        logger.info(f"Embedding: Using {workers} {embedding_model_name} workers")
+    elif embedding_model_name == "sentence_transformer_int8":
+        model = "all-MiniLM-L6-v2"
+        embeddings = QuantizedSentenceTransformerEmbeddings(
+            model,
+            cache_folder="/embedding_model",
+            batch_size=int(config.get("local_batch_size") or 64),
+            threads=int(config.get("local_threads") or 0),
+        )
+        dimension = 384
+        logger.info("Embedding: Using SentenceTransformer, int8 quantized")
     else:
+        model = "all-MiniLM-L6-v2"
         embeddings = HuggingFaceEmbeddings(
-            model_name="all-MiniLM-L6-v2", cache_folder="/embedding_model"
+            model_name=model,
+            cache_folder="/embedding_model",
+            encode_kwargs={"batch_size": int(config.get("local_batch_size") or 32)},
         )
         dimension = 384
         logger.info("Embedding: Using SentenceTransformer")
+    if config.get("cache_path"):
+        embeddings = CachedEmbeddings(
+            embeddings,
+            backend=embedding_model_name,
+            model=model,
+            path=config["cache_path"],
+            max_entries=int(config.get("cache_max_entries") or 500_000),
+        )
+        logger.info(f"Embedding: Caching vectors in {config['cache_path']}")
     return embeddings, dimension
 
 
@@ -114,8 +443,27 @@ def configure_llm_only_chain(llm):
     return chain
 
 
-def configure_qa_rag_chain(llm, embeddings, embeddings_store_url, username, password):
-    # RAG response
+def load_token_counter(llm):
+    """Returns a function counting the prompt tokens of a text for `llm`.
+
+    OpenAI models count with their own tokenizer. Other backends don't expose
+    one locally, so tiktoken's cl100k_base encoding stands in, which is close
+    for the BPE vocabularies of Llama and Mistral models; without tiktoken
+    (or its encoding files) a 4 characters per token estimate is used.
+    """
+    if isinstance(llm, ChatOpenAI):
+        return llm.get_num_tokens
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception:
+        return lambda text: len(text) // 4 + 1
+
+
+def configure_qa_answer_chain(llm):
+    # Answers a {"summaries", "question"} input from already retrieved context
     #   System: Always talk in pirate speech.
     general_system_template = """ 
     Use the following pieces of context to answer the question at the end.
@@ -141,61 +489,517 @@ def configure_qa_rag_chain(llm, embeddings, embeddings_store_url, username, pass
     ]
     qa_prompt = ChatPromptTemplate.from_messages(messages)
 
-    # Vector + Knowledge Graph response
-    kg = Neo4jVector.from_existing_index(
-        embedding=embeddings,
-        url=embeddings_store_url,
-        username=username,
-        password=password,
-        database="neo4j",  # neo4j by default
-        index_name="stackoverflow",  # vector by default
-        text_node_property="body",  # text by default
-        retrieval_query="""
-    WITH node AS question, score AS similarity
+    return qa_prompt | llm | StrOutputParser()
+
+
+# Renders each matched question with its best answers, also kept apart in
+# the metadata for build_context; shared by the vector and the full-text
+# retrieval so both return comparable documents
+QUESTION_CONTEXT_QUERY = """
     CALL  { with question
         MATCH (question)<-[:ANSWERS]-(answer)
         WITH answer
         ORDER BY answer.is_accepted DESC, answer.score DESC
-        WITH collect(answer)[..2] as answers
-        RETURN reduce(str='', answer IN answers | str + 
+        WITH collect(answer)[..$answers_per_question] as answers
+        RETURN answers, reduce(str='', answer IN answers | str + 
                 '\n### Answer (Accepted: '+ answer.is_accepted +
                 ' Score: ' + answer.score+ '): '+  answer.body + '\n') as answerTexts
     } 
     RETURN '##Question: ' + question.title + '\n' + question.body + '\n' 
-        + answerTexts AS text, similarity as score, {source: question.link} AS metadata
+        + answerTexts AS text, similarity as score,
+        {source: question.link, title: question.title, question: question.body,
+         answers: [answer IN answers | {is_accepted: answer.is_accepted,
+                                        score: answer.score, body: answer.body}]
+        } AS metadata
     ORDER BY similarity ASC // so that best answers are the last
-    """,
+"""
+
+# Keyword search over questions and answers; an answer hit stands for its question
+FULLTEXT_RETRIEVAL_QUERY = """
+    CALL db.index.fulltext.queryNodes('stackoverflow_fulltext', $query, {limit: $limit})
+    YIELD node, score
+    WITH CASE WHEN node:Answer THEN [(node)-[:ANSWERS]->(q) | q][0] ELSE node END
+        AS question, score
+    WITH question, max(score) AS similarity
+    WHERE question IS NOT NULL
+    ORDER BY similarity DESC
+    LIMIT $k
+""" + QUESTION_CONTEXT_QUERY
+
+RETRIEVAL_MODES = ("vector", "hybrid")
+
+
+def load_stackoverflow_store(embeddings, embeddings_store_url, username, password):
+    # Vector + Knowledge Graph response
+    return Neo4jVector.from_existing_index(
+        embedding=embeddings,
+        url=embeddings_store_url,
+        username=username,
+        password=password,
+        database="neo4j",  # neo4j by default
+        index_name="stackoverflow",  # vector by default
+        text_node_property="body",  # text by default
+        retrieval_query="WITH node AS question, score AS similarity"
+        + QUESTION_CONTEXT_QUERY,
     )
-    kg_qa = (
-        RunnableParallel(
-            {
-                "summaries": kg.as_retriever(search_kwargs={"k": 2}) | format_docs,
-                "question": RunnablePassthrough(),
-            }
+
+
+# Per-request retrieval settings, passed as {"configurable": {...}} in the
+# config of a RAG chain call; missing keys keep the chain's defaults
+RETRIEVAL_OPTIONS = (
+    "k",
+    "answers_per_question",
+    "score_threshold",
+    "max_context_tokens",
+    "rerank",
+)
+
+
+def retrieval_options(config, defaults: dict) -> dict:
+    configurable = (config or {}).get("configurable", {})
+    return {
+        key: configurable[key] if configurable.get(key) is not None else value
+        for key, value in defaults.items()
+    }
+
+
+def search_by_vector(vector_store, question, vector, k, params) -> list:
+    # (doc, score) pairs, best match first. Neo4jVector needs the query text
+    # as well, even when it searches by a given vector
+    return vector_store.similarity_search_with_score_by_vector(
+        vector, k=k, query=question, params=params
+    )
+
+
+def vector_search(
+    vector_store,
+    question,
+    k=2,
+    answers_per_question=2,
+    score_threshold=None,
+    vector=None,
+):
+    # Best match first
+    if vector is None:
+        vector = vector_store.embedding.embed_query(question)
+    results = search_by_vector(
+        vector_store,
+        question,
+        vector,
+        k=k,
+        params={"answers_per_question": answers_per_question},
+    )
+    return [
+        doc
+        for doc, score in reversed(results)
+        if score_threshold is None or score >= score_threshold
+    ]
+
+
+def fulltext_search(vector_store, question, k=2, answers_per_question=2):
+    # Best match first
+    if not question.strip():
+        return []
+    records = vector_store.query(
+        FULLTEXT_RETRIEVAL_QUERY,
+        params={
+            "query": escape_lucene(question),
+            "limit": k * 4,
+            "k": k,
+            "answers_per_question": answers_per_question,
+        },
+    )
+    return [
+        Document(page_content=record["text"], metadata=record["metadata"])
+        for record in reversed(records)
+    ]
+
+
+def reciprocal_rank_fusion(rankings, k=2, rrf_k=60):
+    """Merges best-first document rankings into one list of the top `k`.
+
+    Each document scores sum(1 / (rrf_k + rank)) over the rankings it appears
+    in, so agreement between retrievers outweighs a high rank in only one.
+    Documents are identified by their source link. Like the vector retrieval
+    query, the result is ordered with the best document last.
+    """
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = doc.metadata.get("source") or doc.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [docs[key] for key in reversed(best)]
+
+
+def load_reranker(model_name: str, logger=BaseLogger(), max_length: int = 512):
+    # Local CPU cross-encoder, e.g. cross-encoder/ms-marco-MiniLM-L-6-v2
+    from sentence_transformers import CrossEncoder
+
+    reranker = CrossEncoder(
+        model_name,
+        device="cpu",
+        max_length=max_length,
+        cache_folder="/embedding_model",
+    )
+    logger.info(f"Re-ranker: {model_name}")
+    return reranker
+
+
+def rerank(reranker, question, docs, k=2, batch_size=16):
+    """Keeps the `k` documents the cross-encoder scores best for `question`.
+
+    Unlike the bi-encoder similarity of the vector search, the cross-encoder
+    reads question and candidate together, which ranks much more precisely
+    but costs one model pass per pair, so it only sees the over-fetched
+    candidates. Returns the documents best last.
+    """
+    if len(docs) <= 1:
+        return docs
+    scores = reranker.predict(
+        [(question, doc.page_content) for doc in docs],
+        batch_size=batch_size,
+        show_progress_bar=False,
+    )
+    ranked = sorted(zip(scores, range(len(docs))), reverse=True)[:k]
+    return [docs[i] for _, i in reversed(ranked)]
+
+
+def search_stackoverflow(
+    vector_store,
+    question,
+    retrieval="vector",
+    k=2,
+    answers_per_question=2,
+    score_threshold=None,
+    vector=None,
+    reranker=None,
+    rerank_candidates=10,
+    rerank_batch_size=16,
+):
+    """Retrieves the `k` questions best matching `question`, best last.
+
+    `score_threshold` is a minimum vector similarity. Hybrid retrieval
+    over-fetches from both retrievers so the fusion has candidates to agree
+    on; its full-text matches have no comparable score and are kept. With a
+    `reranker`, `rerank_candidates` questions are retrieved and re-ranked.
+    """
+    if reranker is not None:
+        docs = search_stackoverflow(
+            vector_store,
+            question,
+            retrieval,
+            k=max(k, rerank_candidates),
+            answers_per_question=answers_per_question,
+            score_threshold=score_threshold,
+            vector=vector,
         )
-        | qa_prompt
-        | llm
-        | StrOutputParser()
+        return rerank(reranker, question, docs, k=k, batch_size=rerank_batch_size)
+    if retrieval != "hybrid":
+        return list(
+            reversed(
+                vector_search(
+                    vector_store,
+                    question,
+                    k=k,
+                    answers_per_question=answers_per_question,
+                    score_threshold=score_threshold,
+                    vector=vector,
+                )
+            )
+        )
+    return reciprocal_rank_fusion(
+        [
+            vector_search(
+                vector_store,
+                question,
+                k=k * 2,
+                answers_per_question=answers_per_question,
+                score_threshold=score_threshold,
+                vector=vector,
+            ),
+            fulltext_search(
+                vector_store,
+                question,
+                k=k * 2,
+                answers_per_question=answers_per_question,
+            ),
+        ],
+        k=k,
     )
+
+
+def configure_qa_rag_chain(
+    llm,
+    embeddings,
+    embeddings_store_url,
+    username,
+    password,
+    retrieval_cache=None,
+    vector_store=None,
+    retrieval="vector",
+    k=2,
+    answers_per_question=2,
+    score_threshold=None,
+    max_context_tokens=1500,
+    count_tokens=None,
+    logger=BaseLogger(),
+    reranker=None,
+    rerank_candidates=10,
+    rerank_batch_size=16,
+):
+    # RAG response; retrieval is "vector" or "hybrid" (vector + full-text).
+    # The retrieval settings are defaults, see RETRIEVAL_OPTIONS; "rerank"
+    # only applies when a reranker is given
+    kg = vector_store
+    if kg is None:
+        kg = load_stackoverflow_store(
+            embeddings, embeddings_store_url, username, password
+        )
+    count_tokens = count_tokens or load_token_counter(llm)
+    defaults = {
+        "k": k,
+        "answers_per_question": answers_per_question,
+        "score_threshold": score_threshold,
+        "max_context_tokens": max_context_tokens,
+        "rerank": reranker is not None,
+    }
+
+    def retrieve(question, config):
+        options = retrieval_options(config, defaults)
+        # The embedding of the question, when the caller already computed it
+        vector = (config or {}).get("configurable", {}).get("vector")
+        search = {
+            key: options[key]
+            for key in ("k", "answers_per_question", "score_threshold")
+        }
+        if options["rerank"] and reranker is not None:
+            search.update(
+                reranker=reranker,
+                rerank_candidates=rerank_candidates,
+                rerank_batch_size=rerank_batch_size,
+            )
+        if retrieval_cache is None:
+            return search_stackoverflow(
+                kg, question, retrieval, vector=vector, **search
+            )
+        # Serve repeated (or, with a similarity threshold, paraphrased) questions
+        # from the cache instead of running the search and retrieval query
+        namespace = ":".join(
+            [retrieval]
+            + [str(options[key]) for key in ("k", "answers_per_question")]
+            + [str(options["score_threshold"]), str("reranker" in search)]
+        )
+        docs, embedding = retrieval_cache.lookup(
+            question, namespace=namespace, embedding=vector
+        )
+        if docs is None:
+            if embedding is None:
+                embedding = vector
+            docs = search_stackoverflow(
+                kg, question, retrieval, vector=embedding, **search
+            )
+            retrieval_cache.put(question, docs, embedding, namespace=namespace)
+        return docs
+
+    def assemble_context(docs, config):
+        budget = retrieval_options(config, defaults)["max_context_tokens"]
+        context, tokens = build_context(docs, budget, count_tokens)
+        logger.info(f"RAG context: {len(docs)} documents, {tokens}/{budget} tokens")
+        return context
+
+    kg_qa = RunnableParallel(
+        {
+            "summaries": RunnableLambda(retrieve) | RunnableLambda(assemble_context),
+            "question": RunnablePassthrough(),
+        }
+    ) | configure_qa_answer_chain(llm)
     return kg_qa
 
 
-def generate_ticket(neo4j_graph, llm_chain, input_question):
-    # Get high ranked questions
-    records = neo4j_graph.query(
-        "MATCH (q:Question) RETURN q.title AS title, q.body AS body ORDER BY q.score DESC LIMIT 3"
-    )
-    questions = []
-    for i, question in enumerate(records, start=1):
-        questions.append((question["title"], question["body"]))
-    # Ask LLM to generate new question in the same style
-    questions_prompt = ""
-    for i, question in enumerate(questions, start=1):
-        questions_prompt += f"{i}. \n{question[0]}\n----\n\n"
-        questions_prompt += f"{question[1][:150]}\n\n"
-        questions_prompt += "----\n\n"
-
-    gen_system_template = f"""
+# Retrieval settings of the "shallow" route of QueryRouter
+SHALLOW_RETRIEVAL = {
+    "k": 1,
+    "answers_per_question": 1,
+    "max_context_tokens": 500,
+    "rerank": False,
+}
+
+# Centroid of each of the most used tags: the sum of (a sample of) the
+# embeddings of its questions, only its direction matters
+TAG_CENTROIDS_QUERY = """
+MATCH (t:Tag)<-[:TAGGED]-(:Question)
+WITH t, count(*) AS questions
+ORDER BY questions DESC
+LIMIT $max_tags
+CALL { WITH t
+    MATCH (t)<-[:TAGGED]-(q:Question)
+    WHERE q.embedding IS NOT NULL
+    WITH q LIMIT $sample_size
+    RETURN collect(q.embedding) AS embeddings
+}
+WITH t, embeddings WHERE size(embeddings) > 0
+RETURN t.name AS tag,
+    [i IN range(0, size(embeddings[0]) - 1) |
+        reduce(total = 0.0, embedding IN embeddings | total + embedding[i])] AS centroid
+"""
+
+
+class QueryRouter:
+    """Decides how much retrieval a RAG question gets: "rag", "shallow" or "llm".
+
+    A question far from every tag centroid is off-topic for the graph and
+    goes to the LLM alone, without a vector search. Otherwise the similarity
+    of the best matching question picks full RAG (from `full_score`), a
+    shallow retrieval (from `min_score`) or the LLM alone. The centroids are
+    computed in Neo4j and recomputed when the data version changes, checked
+    at most every `refresh_interval` seconds. Both happen in a background
+    thread; questions are routed with the previous centroids meanwhile, and
+    without the tag check until the first ones are ready.
+    """
+
+    def __init__(
+        self,
+        neo4j_graph,
+        vector_store,
+        embeddings,
+        min_tag_similarity: float = 0.2,
+        min_score: float = 0.7,
+        full_score: float = 0.8,
+        refresh_interval: float = 300,
+        max_tags: int = 100,
+        sample_size: int = 200,
+    ):
+        self.neo4j_graph = neo4j_graph
+        self.vector_store = vector_store
+        self.embeddings = embeddings
+        self.min_tag_similarity = min_tag_similarity
+        self.min_score = min_score
+        self.full_score = full_score
+        self.refresh_interval = refresh_interval
+        self.max_tags = max_tags
+        self.sample_size = sample_size
+        self._tags = []
+        self._centroids = None
+        self._version = None
+        self._checked_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def route(self, question: str, vector=None) -> dict:
+        if vector is None:
+            vector = self.embeddings.embed_query(question)
+        decision = {}
+        tags, centroids = self._tag_centroids()
+        if tags:
+            query = np.asarray(vector, dtype=np.float32)
+            similarities = centroids @ (query / (np.linalg.norm(query) or 1.0))
+            best = int(np.argmax(similarities))
+            decision["tag"] = tags[best]
+            decision["tag_similarity"] = round(float(similarities[best]), 4)
+            if similarities[best] < self.min_tag_similarity:
+                return {"route": "llm", **decision}
+        # Only the score is needed, so the retrieval query skips the answers
+        results = search_by_vector(
+            self.vector_store,
+            question,
+            vector,
+            k=1,
+            params={"answers_per_question": 0},
+        )
+        score = results[0][1] if results else 0.0
+        decision["score"] = round(float(score), 4)
+        if score >= self.full_score:
+            route = "rag"
+        elif score >= self.min_score:
+            route = "shallow"
+        else:
+            route = "llm"
+        return {"route": route, **decision}
+
+    def _tag_centroids(self) -> tuple:
+        with self._lock:
+            now = time.monotonic()
+            refresh = not self._refreshing and (
+                self._centroids is None
+                or now - self._checked_at >= self.refresh_interval
+            )
+            if refresh:
+                self._checked_at = now
+                self._refreshing = True
+            tags, centroids = self._tags, self._centroids
+        if refresh:
+            threading.Thread(target=self._refresh, daemon=True).start()
+        return tags, centroids
+
+    def _refresh(self) -> None:
+        try:
+            version = get_data_version(self.neo4j_graph)
+            if self._centroids is not None and version == self._version:
+                return
+            records = self.neo4j_graph.query(
+                TAG_CENTROIDS_QUERY,
+                params={"max_tags": self.max_tags, "sample_size": self.sample_size},
+            )
+            centroids = np.asarray(
+                [record["centroid"] for record in records], dtype=np.float32
+            ).reshape(len(records), -1)
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            with self._lock:
+                self._tags = [record["tag"] for record in records]
+                self._centroids = centroids / np.where(norms == 0, 1.0, norms)
+                self._version = version
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+class TicketPrompt:
+    """The few-shot prompt of generate_ticket, compiled once and cached.
+
+    The example questions are the top-scored ones in the graph. They are
+    looked up again at most every `refresh_interval` seconds, and only when
+    the data version shows the loader imported something since.
+    """
+
+    def __init__(self, neo4j_graph, refresh_interval: float = 300):
+        self.neo4j_graph = neo4j_graph
+        self.refresh_interval = refresh_interval
+        self._prompt = None
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> ChatPromptTemplate:
+        with self._lock:
+            now = time.monotonic()
+            if self._prompt is None or now - self._checked_at >= self.refresh_interval:
+                self._checked_at = now
+                version = get_data_version(self.neo4j_graph)
+                if self._prompt is None or version != self._version:
+                    self._prompt = self._compile()
+                    self._version = version
+            return self._prompt
+
+    def _compile(self) -> ChatPromptTemplate:
+        # Get high ranked questions
+        records = self.neo4j_graph.query(
+            "MATCH (q:Question) WHERE q.score IS NOT NULL "
+            "RETURN q.title AS title, q.body AS body ORDER BY q.score DESC LIMIT 3"
+        )
+        questions = []
+        for i, question in enumerate(records, start=1):
+            questions.append((question["title"], question["body"]))
+        # Ask LLM to generate new question in the same style
+        questions_prompt = ""
+        for i, question in enumerate(questions, start=1):
+            questions_prompt += f"{i}. \n{question[0]}\n----\n\n"
+            questions_prompt += f"{question[1][:150]}\n\n"
+            questions_prompt += "----\n\n"
+
+        gen_system_template = f"""
     You're an expert in formulating high quality questions. 
     Formulate a question in the same style and tone as the following example questions.
     {questions_prompt}
@@ -210,29 +1014,269 @@ def generate_ticket(neo4j_graph, llm_chain, input_question):
     Question: This is a new question
     ---
     """
-    # we need jinja2 since the questions themselves contain curly braces
-    system_prompt = SystemMessagePromptTemplate.from_template(
-        gen_system_template, template_format="jinja2"
-    )
-    chat_prompt = ChatPromptTemplate.from_messages(
-        [
-            system_prompt,
-            SystemMessagePromptTemplate.from_template(
-                """
+        # A literal message, since the questions themselves contain curly braces
+        system_prompt = SystemMessage(content=gen_system_template)
+        return ChatPromptTemplate.from_messages(
+            [
+                system_prompt,
+                SystemMessagePromptTemplate.from_template(
+                    """
                 Respond in the following template format or you will be unplugged.
                 ---
                 Title: New title
                 Question: New question
                 ---
                 """
-            ),
-            HumanMessagePromptTemplate.from_template("{question}"),
-        ]
-    )
-    llm_response = llm_chain(
-        f"Here's the question to rewrite in the expected format: ```{input_question}```",
-        [],
-        chat_prompt,
+                ),
+                HumanMessagePromptTemplate.from_template("{question}"),
+            ]
+        )
+
+
+def configure_ticket_chain(ticket_prompt: TicketPrompt, llm):
+    # Rewrites a question string into a "Title: ... Question: ..." ticket draft
+    return (
+        RunnableLambda(
+            lambda input_question: {
+                "question": f"Here's the question to rewrite in the expected format: ```{input_question}```"
+            }
+        )
+        # Returning the prompt runs it, with the examples current at call time
+        | RunnableLambda(lambda _: ticket_prompt.get())
+        | llm
+        | StrOutputParser()
     )
-    new_title, new_question = extract_title_and_question(llm_response["answer"])
+
+
+def generate_ticket(ticket_chain, input_question):
+    llm_response = ticket_chain.invoke(input_question)
+    new_title, new_question = extract_title_and_question(llm_response)
     return (new_title, new_question)
+
+
+def config_from_env() -> dict:
+    return {
+        "neo4j_url": os.getenv("NEO4J_URI"),
+        "neo4j_username": os.getenv("NEO4J_USERNAME"),
+        "neo4j_password": os.getenv("NEO4J_PASSWORD"),
+        "ollama_base_url": os.getenv("OLLAMA_BASE_URL"),
+        "embedding_model": os.getenv("EMBEDDING_MODEL"),
+        "embedding_cache_path": os.getenv("EMBEDDING_CACHE_PATH"),
+        "embedding_cache_max_entries": os.getenv("EMBEDDING_CACHE_MAX_ENTRIES"),
+        "embedding_local_batch_size": os.getenv("LOCAL_EMBEDDING_BATCH_SIZE"),
+        "embedding_local_threads": os.getenv("LOCAL_EMBEDDING_THREADS"),
+        "embedding_workers": os.getenv("EMBEDDING_WORKERS"),
+        "llm": os.getenv("LLM"),
+        "retrieval_cache_size": int(os.getenv("RETRIEVAL_CACHE_SIZE", "1000")),
+        "retrieval_cache_ttl": float(os.getenv("RETRIEVAL_CACHE_TTL", "600")),
+        "retrieval_cache_similarity": os.getenv("RETRIEVAL_CACHE_SIMILARITY"),
+        "max_context_tokens": int(os.getenv("MAX_CONTEXT_TOKENS", "1500")),
+        "rerank_model": os.getenv("RERANK_MODEL"),
+        "rerank_candidates": int(os.getenv("RERANK_CANDIDATES", "10")),
+        "rerank_batch_size": int(os.getenv("RERANK_BATCH_SIZE", "16")),
+        "ticket_examples_refresh": float(os.getenv("TICKET_EXAMPLES_REFRESH", "300")),
+        "router_min_tag_similarity": float(
+            os.getenv("ROUTER_MIN_TAG_SIMILARITY", "0.2")
+        ),
+        "router_min_score": float(os.getenv("ROUTER_MIN_SCORE", "0.7")),
+        "router_full_score": float(os.getenv("ROUTER_FULL_SCORE", "0.8")),
+    }
+
+
+class ChainRegistry:
+    """Builds the models, stores and chains of one configuration on first use.
+
+    Every object is created once and shared afterwards, so importing an app
+    costs nothing until a request needs a model; `warm_up` builds everything
+    ahead of time.
+    """
+
+    def __init__(self, config: dict, logger=BaseLogger()):
+        self.config = config
+        self.logger = logger
+        self._items = {}
+        # One lock per item, so a slow build (e.g. loading a model) only
+        # blocks the callers waiting for that item
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _get(self, key, build):
+        if key in self._items:
+            return self._items[key]
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.RLock())
+        with lock:
+            if key not in self._items:
+                self._items[key] = build()
+            return self._items[key]
+
+    def _embedding_model(self):
+        return self._get(
+            "embedding_model",
+            lambda: load_embedding_model(
+                self.config["embedding_model"],
+                logger=self.logger,
+                config={
+                    "ollama_base_url": self.config["ollama_base_url"],
+                    "cache_path": self.config["embedding_cache_path"],
+                    "cache_max_entries": self.config["embedding_cache_max_entries"],
+                    "local_batch_size": self.config["embedding_local_batch_size"],
+                    "local_threads": self.config["embedding_local_threads"],
+                    "workers": self.config["embedding_workers"],
+                },
+            ),
+        )
+
+    def embeddings(self):
+        return self._embedding_model()[0]
+
+    def dimension(self) -> int:
+        return self._embedding_model()[1]
+
+    def llm(self):
+        return self._get(
+            "llm",
+            lambda: load_llm(
+                self.config["llm"],
+                logger=self.logger,
+                config={"ollama_base_url": self.config["ollama_base_url"]},
+            ),
+        )
+
+    def neo4j_graph(self):
+        def build():
+            # if Neo4j is local, you can go to http://localhost:7474/ to browse the database
+            graph = Neo4jGraph(
+                url=self.config["neo4j_url"],
+                username=self.config["neo4j_username"],
+                password=self.config["neo4j_password"],
+                refresh_schema=False,
+            )
+            create_vector_index(graph)
+            create_fulltext_index(graph)
+            return graph
+
+        return self._get("neo4j_graph", build)
+
+    def stackoverflow_store(self):
+        self.neo4j_graph()  # makes sure the vector index exists
+        return self._get(
+            "stackoverflow_store",
+            lambda: load_stackoverflow_store(
+                self.embeddings(),
+                embeddings_store_url=self.config["neo4j_url"],
+                username=self.config["neo4j_username"],
+                password=self.config["neo4j_password"],
+            ),
+        )
+
+    def retrieval_cache(self):
+        similarity = self.config["retrieval_cache_similarity"]
+        return self._get(
+            "retrieval_cache",
+            lambda: SemanticCache(
+                max_size=self.config["retrieval_cache_size"],
+                ttl=self.config["retrieval_cache_ttl"],
+                similarity_threshold=float(similarity) if similarity else None,
+                embed=lambda text: self.embeddings().embed_query(text),
+                version=lambda: get_data_version(self.neo4j_graph()),
+            ),
+        )
+
+    def reranker(self):
+        # None unless RERANK_MODEL is set
+        model_name = self.config["rerank_model"]
+        return self._get(
+            "reranker",
+            lambda: load_reranker(model_name, self.logger) if model_name else None,
+        )
+
+    def reranking(self) -> dict:
+        # Keyword arguments of search_stackoverflow for re-ranking
+        if self.reranker() is None:
+            return {}
+        return {
+            "reranker": self.reranker(),
+            "rerank_candidates": self.config["rerank_candidates"],
+            "rerank_batch_size": self.config["rerank_batch_size"],
+        }
+
+    def token_counter(self):
+        return self._get("token_counter", lambda: load_token_counter(self.llm()))
+
+    def llm_chain(self):
+        return self._get("llm_chain", lambda: configure_llm_only_chain(self.llm()))
+
+    def qa_answer_chain(self):
+        return self._get(
+            "qa_answer_chain", lambda: configure_qa_answer_chain(self.llm())
+        )
+
+    def rag_chain(self, retrieval: str = "vector"):
+        if retrieval not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode: {retrieval}")
+        if retrieval == "hybrid":
+            self.neo4j_graph()  # makes sure the full-text index exists
+        return self._get(
+            f"rag_chain:{retrieval}",
+            lambda: configure_qa_rag_chain(
+                self.llm(),
+                self.embeddings(),
+                embeddings_store_url=self.config["neo4j_url"],
+                username=self.config["neo4j_username"],
+                password=self.config["neo4j_password"],
+                retrieval_cache=self.retrieval_cache(),
+                vector_store=self.stackoverflow_store(),
+                retrieval=retrieval,
+                max_context_tokens=self.config["max_context_tokens"],
+                count_tokens=self.token_counter(),
+                logger=self.logger,
+                reranker=self.reranker(),
+                rerank_candidates=self.config["rerank_candidates"],
+                rerank_batch_size=self.config["rerank_batch_size"],
+            ),
+        )
+
+    def query_router(self):
+        return self._get(
+            "query_router",
+            lambda: QueryRouter(
+                self.neo4j_graph(),
+                self.stackoverflow_store(),
+                self.embeddings(),
+                min_tag_similarity=self.config["router_min_tag_similarity"],
+                min_score=self.config["router_min_score"],
+                full_score=self.config["router_full_score"],
+            ),
+        )
+
+    def ticket_chain(self):
+        return self._get(
+            "ticket_chain",
+            lambda: configure_ticket_chain(
+                TicketPrompt(
+                    self.neo4j_graph(),
+                    refresh_interval=self.config["ticket_examples_refresh"],
+                ),
+                self.llm(),
+            ),
+        )
+
+    def warm_up(self) -> None:
+        self.neo4j_graph()
+        self.llm_chain()
+        self.rag_chain()
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(config: dict = None, logger=BaseLogger()) -> ChainRegistry:
+    # One registry per distinct configuration, shared by everything in the process
+    config = config or config_from_env()
+    key = tuple(sorted(config.items()))
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = ChainRegistry(config, logger=logger)
+        return _registries[key]
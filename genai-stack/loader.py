@@ -1,11 +1,23 @@
 import os
+import argparse
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty, Full
+from threading import Event, Lock, Thread
 from dotenv import load_dotenv
 from langchain_neo4j import Neo4jGraph
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
 import streamlit as st
+from streamlit import runtime
 from streamlit.logger import get_logger
 from chains import load_embedding_model
-from utils import create_constraints, create_vector_index
+from utils import (
+    bump_data_version,
+    create_constraints,
+    create_fulltext_index,
+    create_vector_index,
+)
 from PIL import Image
 
 load_dotenv(".env")
@@ -15,31 +27,99 @@ username = os.getenv("NEO4J_USERNAME")
 password = os.getenv("NEO4J_PASSWORD")
 ollama_base_url = os.getenv("OLLAMA_BASE_URL")
 embedding_model_name = os.getenv("EMBEDDING_MODEL")
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH")
+embedding_cache_max_entries = os.getenv("EMBEDDING_CACHE_MAX_ENTRIES")
+local_embedding_batch_size = os.getenv("LOCAL_EMBEDDING_BATCH_SIZE")
+local_embedding_threads = os.getenv("LOCAL_EMBEDDING_THREADS")
+embedding_workers = os.getenv("EMBEDDING_WORKERS")
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+embedding_concurrency = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+import_embed_workers = int(os.getenv("IMPORT_EMBED_WORKERS", "2"))
+import_queue_size = int(os.getenv("IMPORT_QUEUE_SIZE", "2"))
+neo4j_write_batch_size = int(os.getenv("NEO4J_WRITE_BATCH_SIZE", "200"))
+neo4j_write_retries = int(os.getenv("NEO4J_WRITE_RETRIES", "3"))
 
 logger = get_logger(__name__)
 
 so_api_base_url = "https://api.stackexchange.com/2.3/search/advanced"
 
-embeddings, dimension = load_embedding_model(
-    embedding_model_name, config={"ollama_base_url": ollama_base_url}, logger=logger
-)
+embeddings = None
+dimension = None
+neo4j_graph = None
 
-# if Neo4j is local, you can go to http://localhost:7474/ to browse the database
-neo4j_graph = Neo4jGraph(
-    url=url, username=username, password=password, refresh_schema=False
+resource_config = (
+    ("url", url),
+    ("username", username),
+    ("password", password),
+    ("embedding_model", embedding_model_name),
+    ("ollama_base_url", ollama_base_url),
+    ("cache_path", embedding_cache_path),
+    ("cache_max_entries", embedding_cache_max_entries),
+    ("local_batch_size", local_embedding_batch_size),
+    ("local_threads", local_embedding_threads),
+    ("workers", embedding_workers),
 )
 
-create_constraints(neo4j_graph)
-create_vector_index(neo4j_graph)
 
+def load_resources(config: tuple) -> tuple:
+    # The embedding model and the graph, with its constraints and indexes
+    settings = dict(config)
+    neo4j = {key: settings.pop(key) for key in ("url", "username", "password")}
+    embeddings, dimension = load_embedding_model(
+        settings.pop("embedding_model"), config=settings, logger=logger
+    )
 
-def load_so_data(tag: str = "neo4j", page: int = 1) -> None:
+    # if Neo4j is local, you can go to http://localhost:7474/ to browse the database
+    neo4j_graph = Neo4jGraph(**neo4j, refresh_schema=False)
+
+    create_constraints(neo4j_graph)
+    create_vector_index(neo4j_graph)
+    create_fulltext_index(neo4j_graph)
+    return embeddings, dimension, neo4j_graph
+
+
+# Shared by all sessions and reruns of the UI, so an import does not load a
+# new model (or start new embedding workers); a changed configuration
+# replaces them
+load_cached_resources = st.cache_resource(max_entries=1)(load_resources)
+
+
+def setup(load=load_resources) -> None:
+    # Not done at import time: the embedding worker processes re-import this
+    # module and must not load a model or connect to Neo4j of their own
+    global embeddings, dimension, neo4j_graph
+    embeddings, dimension, neo4j_graph = load(resource_config)
+
+
+def fetch_so_data(parameters: str) -> dict:
+    data = requests.get(so_api_base_url + parameters).json()
+    if "error_id" in data:
+        raise Exception(f"StackExchange API: {data.get('error_message')}")
+    # The API asks clients to pause before the next request when throttling
+    time.sleep(data.get("backoff", 0))
+    return data
+
+
+def fetch_so_page(tag: str = "neo4j", page: int = 1) -> dict:
     parameters = (
         f"?pagesize=100&page={page}&order=desc&sort=creation&answers=1&tagged={tag}"
         "&site=stackoverflow&filter=!*236eb_eL9rai)MOSNZ-6D3Q6ZKb0buI*IVotWaTb"
     )
-    data = requests.get(so_api_base_url + parameters).json()
-    insert_so_data(data)
+    return fetch_so_data(parameters)
+
+
+def fetch_so_updates(tag: str, since: int, page: int = 1) -> dict:
+    # Oldest activity first, so every committed page moves the high-water mark forward
+    parameters = (
+        f"?pagesize=100&page={page}&order=asc&sort=activity&min={since}&answers=1"
+        f"&tagged={tag}&site=stackoverflow"
+        "&filter=!*236eb_eL9rai)MOSNZ-6D3Q6ZKb0buI*IVotWaTb"
+    )
+    return fetch_so_data(parameters)
+
+
+def load_so_data(tag: str = "neo4j", page: int = 1) -> None:
+    insert_so_data(fetch_so_page(tag, page))
 
 
 def load_high_score_so_data() -> None:
@@ -47,52 +127,433 @@ def load_high_score_so_data() -> None:
         f"?fromdate=1664150400&order=desc&sort=votes&site=stackoverflow&"
         "filter=!.DK56VBPooplF.)bWW5iOX32Fh1lcCkw1b_Y6Zkb7YD8.ZMhrR5.FRRsR6Z1uK8*Z5wPaONvyII"
     )
-    data = requests.get(so_api_base_url + parameters).json()
-    insert_so_data(data)
+    insert_so_data(fetch_so_data(parameters))
 
 
-def insert_so_data(data: dict) -> None:
-    # Calculate embedding values for questions and answers
+def embed_texts(texts: list) -> list:
+    # Send texts through embed_documents in batches, several batches at a time
+    batches = [
+        texts[i : i + embedding_batch_size]
+        for i in range(0, len(texts), embedding_batch_size)
+    ]
+    if len(batches) <= 1:
+        return embeddings.embed_documents(texts) if texts else []
+    with ThreadPoolExecutor(max_workers=embedding_concurrency) as executor:
+        results = executor.map(embeddings.embed_documents, batches)
+    return [vector for batch in results for vector in batch]
+
+
+def get_stored_texts(data: dict) -> tuple:
+    # Title and body of questions and answers of this page that are already imported
+    records = neo4j_graph.query(
+        """
+    UNWIND $question_ids AS id
+    MATCH (q:Question {id: id})
+    RETURN q.id AS id, q.title AS title, q.body AS body
+    """,
+        {"question_ids": [q["question_id"] for q in data["items"]]},
+    )
+    questions = {r["id"]: (r["title"], r["body"]) for r in records}
+    records = neo4j_graph.query(
+        """
+    UNWIND $answer_ids AS id
+    MATCH (a:Answer {id: id})
+    RETURN a.id AS id, a.body AS body
+    """,
+        {
+            "answer_ids": [
+                a["answer_id"] for q in data["items"] for a in q["answers"]
+            ]
+        },
+    )
+    answers = {r["id"]: r["body"] for r in records}
+    return questions, answers
+
+
+def embed_so_data(data: dict) -> None:
+    # Collect question and answer texts of the whole page, then embed them at once.
+    # Questions and answers stored with unchanged text keep their embedding.
+    stored_questions, stored_answers = get_stored_texts(data)
+    targets, texts = [], []
     for q in data["items"]:
         question_text = q["title"] + "\n" + q["body_markdown"]
-        q["embedding"] = embeddings.embed_query(question_text)
+        question_unchanged = stored_questions.get(q["question_id"]) == (
+            q["title"],
+            q["body_markdown"],
+        )
+        if question_unchanged:
+            q["embedding"] = None
+        else:
+            targets.append(q)
+            texts.append(question_text)
         for a in q["answers"]:
-            a["embedding"] = embeddings.embed_query(
-                question_text + "\n" + a["body_markdown"]
-            )
+            if question_unchanged and (
+                stored_answers.get(a["answer_id"]) == a["body_markdown"]
+            ):
+                a["embedding"] = None
+                continue
+            targets.append(a)
+            texts.append(question_text + "\n" + a["body_markdown"])
+
+    for target, vector in zip(targets, embed_texts(texts)):
+        target["embedding"] = vector
+
+
+def insert_so_data(data: dict) -> None:
+    # Calculate embedding values for questions and answers
+    embed_so_data(data)
+    write_so_data(data)
 
+
+def write_batches(query: str, rows: list) -> None:
+    # Each batch is its own transaction; transient failures retry only that batch
+    for i in range(0, len(rows), neo4j_write_batch_size):
+        batch = rows[i : i + neo4j_write_batch_size]
+        for attempt in range(neo4j_write_retries + 1):
+            try:
+                neo4j_graph.query(query, {"rows": batch})
+                break
+            except (TransientError, ServiceUnavailable, SessionExpired) as e:
+                if attempt == neo4j_write_retries:
+                    raise
+                logger.info(f"Retrying batch after transient error: {e}")
+                time.sleep(2**attempt)
+
+
+def write_so_data(data: dict) -> None:
     # Cypher, the query language of Neo4j, is used to import the data
     # https://neo4j.com/docs/getting-started/cypher-intro/
     # https://neo4j.com/docs/cypher-cheat-sheet/5/auradb-enterprise/
-    import_query = """
-    UNWIND $data AS q
-    MERGE (question:Question {id:q.question_id}) 
-    ON CREATE SET question.title = q.title, question.link = q.link, question.score = q.score,
-        question.favorite_count = q.favorite_count, question.creation_date = datetime({epochSeconds: q.creation_date}),
-        question.body = q.body_markdown, question.embedding = q.embedding
-    FOREACH (tagName IN q.tags | 
-        MERGE (tag:Tag {name:tagName}) 
-        MERGE (question)-[:TAGGED]->(tag)
-    )
-    FOREACH (a IN q.answers |
-        MERGE (question)<-[:ANSWERS]-(answer:Answer {id:a.answer_id})
-        SET answer.is_accepted = a.is_accepted,
-            answer.score = a.score,
-            answer.creation_date = datetime({epochSeconds:a.creation_date}),
-            answer.body = a.body_markdown,
-            answer.embedding = a.embedding
-        MERGE (answerer:User {id:coalesce(a.owner.user_id, "deleted")}) 
-        ON CREATE SET answerer.display_name = a.owner.display_name,
-                      answerer.reputation= a.owner.reputation
-        MERGE (answer)<-[:PROVIDED]-(answerer)
-    )
-    WITH * WHERE NOT q.owner.user_id IS NULL
-    MERGE (owner:User {id:q.owner.user_id})
-    ON CREATE SET owner.display_name = q.owner.display_name,
-                  owner.reputation = q.owner.reputation
+    # Nodes are written first and relationships after, one row batch at a time.
+    # Embeddings go through db.create.setNodeVectorProperty so they are stored
+    # as float vectors rather than lists of 64-bit floats.
+    questions, answers, users, tagged = [], [], {}, []
+    for q in data["items"]:
+        owner = q.get("owner", {})
+        questions.append(
+            {
+                "id": q["question_id"],
+                "title": q["title"],
+                "link": q["link"],
+                "score": q["score"],
+                "favorite_count": q.get("favorite_count"),
+                "creation_date": q["creation_date"],
+                "body": q["body_markdown"],
+                "embedding": q.get("embedding"),
+                "owner_id": owner.get("user_id"),
+            }
+        )
+        tagged.extend({"question_id": q["question_id"], "tag": t} for t in q["tags"])
+        if owner.get("user_id") is not None:
+            users.setdefault(owner["user_id"], owner)
+        for a in q["answers"]:
+            answerer = a.get("owner", {})
+            owner_id = answerer.get("user_id") or "deleted"
+            answers.append(
+                {
+                    "id": a["answer_id"],
+                    "question_id": q["question_id"],
+                    "is_accepted": a["is_accepted"],
+                    "score": a["score"],
+                    "creation_date": a["creation_date"],
+                    "body": a["body_markdown"],
+                    "embedding": a.get("embedding"),
+                    "owner_id": owner_id,
+                }
+            )
+            users.setdefault(owner_id, answerer)
+    users = [
+        {
+            "id": user_id,
+            "display_name": owner.get("display_name"),
+            "reputation": owner.get("reputation"),
+        }
+        for user_id, owner in users.items()
+    ]
+
+    write_batches(
+        """
+    UNWIND $rows AS q
+    MERGE (question:Question {id: q.id})
+    ON CREATE SET question.link = q.link,
+        question.creation_date = datetime({epochSeconds: q.creation_date})
+    SET question.title = q.title, question.score = q.score,
+        question.favorite_count = q.favorite_count, question.body = q.body
+    WITH question, q WHERE q.embedding IS NOT NULL
+    CALL db.create.setNodeVectorProperty(question, 'embedding', q.embedding)
+    """,
+        questions,
+    )
+    write_batches(
+        """
+    UNWIND $rows AS a
+    MERGE (answer:Answer {id: a.id})
+    SET answer.is_accepted = a.is_accepted,
+        answer.score = a.score,
+        answer.creation_date = datetime({epochSeconds: a.creation_date}),
+        answer.body = a.body
+    WITH answer, a WHERE a.embedding IS NOT NULL
+    CALL db.create.setNodeVectorProperty(answer, 'embedding', a.embedding)
+    """,
+        answers,
+    )
+    write_batches(
+        """
+    UNWIND $rows AS u
+    MERGE (user:User {id: u.id})
+    ON CREATE SET user.display_name = u.display_name,
+                  user.reputation = u.reputation
+    """,
+        users,
+    )
+    write_batches(
+        """
+    UNWIND $rows AS row
+    MERGE (:Tag {name: row.tag})
+    """,
+        [{"tag": tag} for tag in {row["tag"] for row in tagged}],
+    )
+
+    write_batches(
+        """
+    UNWIND $rows AS row
+    MATCH (question:Question {id: row.question_id})
+    MATCH (tag:Tag {name: row.tag})
+    MERGE (question)-[:TAGGED]->(tag)
+    """,
+        tagged,
+    )
+    write_batches(
+        """
+    UNWIND $rows AS a
+    MATCH (question:Question {id: a.question_id})
+    MATCH (answer:Answer {id: a.id})
+    MATCH (answerer:User {id: a.owner_id})
+    MERGE (question)<-[:ANSWERS]-(answer)
+    MERGE (answer)<-[:PROVIDED]-(answerer)
+    """,
+        [{k: a[k] for k in ("id", "question_id", "owner_id")} for a in answers],
+    )
+    write_batches(
+        """
+    UNWIND $rows AS q
+    MATCH (question:Question {id: q.id})
+    MATCH (owner:User {id: q.owner_id})
     MERGE (owner)-[:ASKED]->(question)
+    """,
+        [
+            {"id": q["id"], "owner_id": q["owner_id"]}
+            for q in questions
+            if q["owner_id"] is not None
+        ],
+    )
+    # Let the bots and API drop cached retrievals over the previous data
+    bump_data_version(neo4j_graph)
+
+
+class StageStats:
+    # Wall-clock time from the start of the stage's first page to the end of
+    # its last one, however many workers run the stage
+    def __init__(self) -> None:
+        self.pages = 0
+        self.questions = 0
+        self.first_started = None
+        self.last_finished = None
+        self._lock = Lock()
+
+    def record(self, data: dict, started: float) -> None:
+        finished = time.perf_counter()
+        with self._lock:
+            self.pages += 1
+            self.questions += len(data["items"])
+            if self.first_started is None or started < self.first_started:
+                self.first_started = started
+            if self.last_finished is None or finished > self.last_finished:
+                self.last_finished = finished
+
+    def as_dict(self) -> dict:
+        seconds = self.last_finished - self.first_started if self.pages else 0.0
+        return {
+            "pages": self.pages,
+            "questions": self.questions,
+            "seconds": round(seconds, 2),
+            "questions_per_second": (
+                round(self.questions / seconds, 2) if seconds else 0.0
+            ),
+        }
+
+
+def import_so_pages(
+    tag: str,
+    pages,
+    embed_workers: int = import_embed_workers,
+    queue_size: int = import_queue_size,
+    on_page_written=None,
+    fetch_page=fetch_so_page,
+) -> dict:
+    """Import pages as overlapping fetch -> embed -> write stages.
+
+    Bounded queues between the stages keep at most `queue_size` pages waiting
+    in each hand-off, so page N+1 downloads while page N is embedded and page
+    N-1 is written. `on_page_written` runs in the calling thread, so it may
+    update the Streamlit UI. Returns per-stage throughput.
     """
-    neo4j_graph.query(import_query, {"data": data["items"]})
+    fetched = Queue(maxsize=queue_size)
+    embedded = Queue(maxsize=queue_size)
+    written = Queue()
+    stop = Event()
+    errors = []
+    stats = {"fetch": StageStats(), "embed": StageStats(), "write": StageStats()}
+    done = object()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except Full:
+                continue
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except Empty:
+                continue
+        return done
+
+    def stage(target):
+        def run():
+            try:
+                target()
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        return Thread(target=run, daemon=True)
+
+    def fetch():
+        for page in pages:
+            if stop.is_set():
+                break
+            started = time.perf_counter()
+            data = fetch_page(tag, page)
+            stats["fetch"].record(data, started)
+            put(fetched, (page, data))
+            if not data.get("has_more", True):
+                break
+        for _ in range(embed_workers):
+            put(fetched, done)
+
+    def embed():
+        while (item := get(fetched)) is not done:
+            started = time.perf_counter()
+            embed_so_data(item[1])
+            stats["embed"].record(item[1], started)
+            put(embedded, item)
+        put(embedded, done)
+
+    def write():
+        finished = 0
+        while finished < embed_workers:
+            item = get(embedded)
+            if item is done:
+                if stop.is_set():
+                    return
+                finished += 1
+                continue
+            page, data = item
+            started = time.perf_counter()
+            write_so_data(data)
+            stats["write"].record(data, started)
+            written.put((page, data))
+
+    threads = [stage(fetch), *(stage(embed) for _ in range(embed_workers))]
+    threads.append(stage(write))
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    # Report written pages from this thread until the writer is done
+    while threads[-1].is_alive() or not written.empty():
+        try:
+            page, data = written.get(timeout=0.2)
+        except Empty:
+            continue
+        if on_page_written:
+            try:
+                on_page_written(page, data)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    report = {name: stage_stats.as_dict() for name, stage_stats in stats.items()}
+    report["total_seconds"] = round(time.perf_counter() - started, 2)
+    return report
+
+
+def get_sync_state(tag: str) -> dict:
+    records = neo4j_graph.query(
+        """
+    MATCH (s:ImportState {tag: $tag})
+    RETURN s.last_activity_date AS last_activity_date,
+           s.last_creation_date AS last_creation_date
+    """,
+        {"tag": tag},
+    )
+    return records[0] if records else {}
+
+
+def save_sync_state(tag: str, last_activity_date: int, last_creation_date: int):
+    neo4j_graph.query(
+        """
+    MERGE (s:ImportState {tag: $tag})
+    SET s.last_activity_date = $last_activity_date,
+        s.last_creation_date = $last_creation_date,
+        s.updated_at = datetime()
+    """,
+        {
+            "tag": tag,
+            "last_activity_date": last_activity_date,
+            "last_creation_date": last_creation_date,
+        },
+    )
+
+
+def sync_so_data(tag: str, max_pages: int = 100, on_page_written=None) -> dict:
+    """Import only questions of `tag` with activity since the last sync.
+
+    The high-water mark is stored on an (:ImportState {tag}) node and advanced
+    after every page committed in order, so an interrupted sync resumes from
+    the last committed page on the next run.
+    """
+    state = get_sync_state(tag)
+    start = since = state.get("last_activity_date") or 0
+    last_creation_date = state.get("last_creation_date") or 0
+    pending = {}
+    next_page = 1
+
+    def commit(page, data):
+        nonlocal since, last_creation_date, next_page
+        pending[page] = data["items"]
+        while next_page in pending:
+            for q in pending.pop(next_page):
+                since = max(since, q.get("last_activity_date", q["creation_date"]))
+                last_creation_date = max(last_creation_date, q["creation_date"])
+            next_page += 1
+        save_sync_state(tag, since, last_creation_date)
+        if on_page_written:
+            on_page_written(page, data)
+
+    return import_so_pages(
+        tag,
+        range(1, max_pages + 1),
+        on_page_written=commit,
+        fetch_page=lambda tag, page: fetch_so_updates(tag, start, page),
+    )
 
 
 # Streamlit
@@ -116,6 +577,7 @@ def get_pages():
 
 
 def render_page():
+    setup(load_cached_resources)
     datamodel_image = Image.open("./images/datamodel.png")
     st.header("StackOverflow Loader")
     st.subheader("Choose StackOverflow tags to load into Neo4j")
@@ -123,13 +585,37 @@ def render_page():
 
     user_input = get_tag()
     num_pages, start_page = get_pages()
+    incremental = st.checkbox(
+        "Only new or changed questions since the last import of this tag",
+        help="Resumes from the last committed page, up to the number of pages above.",
+    )
 
     if st.button("Import", type="primary"):
         with st.spinner("Loading... This might take a minute or two."):
             try:
-                for page in range(1, num_pages + 1):
-                    load_so_data(user_input, start_page + (page - 1))
+                progress = st.progress(0.0, text="Importing pages")
+                written = []
+
+                def on_page_written(page, data):
+                    written.append(page)
+                    progress.progress(
+                        len(written) / num_pages,
+                        text=f"Imported page {page} ({len(data['items'])} questions)",
+                    )
+
+                if incremental:
+                    report = sync_so_data(
+                        user_input, num_pages, on_page_written=on_page_written
+                    )
+                else:
+                    report = import_so_pages(
+                        user_input,
+                        range(start_page, start_page + num_pages),
+                        on_page_written=on_page_written,
+                    )
                 st.success("Import successful", icon="✅")
+                st.caption("Throughput per stage")
+                st.json(report)
                 st.caption("Data model")
                 st.image(datamodel_image)
                 st.caption("Go to http://localhost:7474/ to interact with the database")
@@ -145,4 +631,40 @@ def render_page():
                     st.error(f"Error: {e}", icon="🚨")
 
 
-render_page()
+def main():
+    parser = argparse.ArgumentParser(description="Import StackOverflow questions")
+    parser.add_argument("--tag", default="neo4j")
+    parser.add_argument("--pages", type=int, default=1)
+    parser.add_argument("--start-page", type=int, default=1)
+    parser.add_argument("--embed-workers", type=int, default=import_embed_workers)
+    parser.add_argument("--queue-size", type=int, default=import_queue_size)
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="only import questions active since the last sync of the tag",
+    )
+    args = parser.parse_args()
+    setup()
+
+    def on_page_written(page, data):
+        logger.info(f"Imported page {page} ({len(data['items'])} questions)")
+
+    if args.sync:
+        report = sync_so_data(args.tag, args.pages, on_page_written=on_page_written)
+    else:
+        report = import_so_pages(
+            args.tag,
+            range(args.start_page, args.start_page + args.pages),
+            embed_workers=args.embed_workers,
+            queue_size=args.queue_size,
+            on_page_written=on_page_written,
+        )
+    for name, value in report.items():
+        logger.info(f"{name}: {value}")
+
+
+# `streamlit run loader.py` renders the UI, `python loader.py ...` imports headless
+if runtime.exists():
+    render_page()
+elif __name__ == "__main__":
+    main()
@@ -1,19 +1,16 @@
+import hashlib
 import os
 
 import streamlit as st
-from PyPDF2 import PdfReader
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.prompts import ChatPromptTemplate
 from langchain_neo4j import Neo4jVector
 from streamlit.logger import get_logger
-from chains import (
-    load_embedding_model,
-    load_llm,
-)
+from chains import ChainRegistry, config_from_env
 from langchain_core.runnables import RunnableParallel, RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
-from utils import format_docs
+from utils import create_pdf_constraints, extract_pdf_pages, format_docs
 
 # load api key lib
 from dotenv import load_dotenv
@@ -24,18 +21,23 @@ load_dotenv(".env")
 url = os.getenv("NEO4J_URI")
 username = os.getenv("NEO4J_USERNAME")
 password = os.getenv("NEO4J_PASSWORD")
-ollama_base_url = os.getenv("OLLAMA_BASE_URL")
-embedding_model_name = os.getenv("EMBEDDING_MODEL")
-llm_name = os.getenv("LLM")
+pdf_extract_workers = int(os.getenv("PDF_EXTRACT_WORKERS", "4"))
+pdf_embed_batch_size = int(os.getenv("PDF_EMBED_BATCH_SIZE", "64"))
 # Remapping for Langchain Neo4j integration
 os.environ["NEO4J_URL"] = url
 
 logger = get_logger(__name__)
 
 
-embeddings, dimension = load_embedding_model(
-    embedding_model_name, config={"ollama_base_url": ollama_base_url}, logger=logger
-)
+# Shared by all sessions and reruns; a changed configuration replaces the
+# cached registry, whose embedding model and LLM are built on first use
+@st.cache_resource(max_entries=1)
+def load_registry(config: tuple) -> ChainRegistry:
+    return ChainRegistry(dict(config), logger=logger)
+
+
+config_key = tuple(sorted(config_from_env().items()))
+registry = load_registry(config_key)
 
 
 class StreamHandler(BaseCallbackHandler):
@@ -48,67 +50,203 @@ class StreamHandler(BaseCallbackHandler):
         self.container.markdown(self.text)
 
 
-llm = load_llm(llm_name, logger=logger, config={"ollama_base_url": ollama_base_url})
-
-
-def main():
-    st.header("📄Chat with your pdf file")
+@st.cache_resource(max_entries=1)
+def load_pdf_store(config: tuple) -> Neo4jVector:
+    # Reuses the pdf_bot index across uploads and questions instead of rebuilding it
+    store = Neo4jVector(
+        embedding=registry.embeddings(),
+        url=url,
+        username=username,
+        password=password,
+        index_name="pdf_bot",
+        node_label="PdfBotChunk",
+    )
+    if not store.retrieve_existing_index():
+        store.create_new_index()
+    create_pdf_constraints(store)
+    return store
+
+
+def is_ingested(store: Neo4jVector, doc_id: str) -> bool:
+    return bool(
+        store.query(
+            "MATCH (d:PdfDocument {id: $doc_id}) RETURN d.id AS id",
+            params={"doc_id": doc_id},
+        )
+    )
 
-    # upload a your pdf file
-    pdf = st.file_uploader("Upload your PDF", type="pdf")
 
-    if pdf is not None:
-        pdf_reader = PdfReader(pdf)
+def store_chunks(store: Neo4jVector, doc_id: str, filename: str, chunks: dict):
+    # Only chunks not stored by an earlier, interrupted ingest are embedded
+    existing = {
+        record["id"]
+        for record in store.query(
+            "MATCH (c:PdfBotChunk) WHERE c.id IN $ids RETURN c.id AS id",
+            params={"ids": list(chunks)},
+        )
+    }
+    missing = [chunk_id for chunk_id in chunks if chunk_id not in existing]
+    if missing:
+        # Store the chunks part in db (vector)
+        store.add_texts(
+            [chunks[chunk_id][0] for chunk_id in missing],
+            metadatas=[
+                {"doc_id": doc_id, "filename": filename, "page": chunks[chunk_id][1]}
+                for chunk_id in missing
+            ],
+            ids=missing,
+        )
 
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text()
 
-        # langchain_textspliter
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000, chunk_overlap=200, length_function=len
-        )
+def ingest_pdf(store: Neo4jVector, data: bytes, filename: str) -> str:
+    """Stores the chunks of a PDF once, keyed by the hash of its content.
+
+    Pages are extracted in parallel and chunked one at a time, and chunks are
+    embedded in batches as soon as enough are ready. Chunk ids derive from the
+    document hash, page and text, so re-ingesting after an interruption only
+    embeds the chunks still missing.
+    """
+    doc_id = hashlib.sha256(data).hexdigest()
+    if is_ingested(store, doc_id):
+        return doc_id
+
+    # langchain_textspliter
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=200, length_function=len
+    )
+
+    batch = {}
+    chunk_count = 0
+    for page_number, page_text in extract_pdf_pages(data, pdf_extract_workers):
+        for chunk in text_splitter.split_text(text=page_text):
+            chunk_id = hashlib.sha256(
+                f"{doc_id}:{page_number}:{chunk}".encode("utf-8")
+            ).hexdigest()
+            batch[chunk_id] = (chunk, page_number)
+        if len(batch) >= pdf_embed_batch_size:
+            store_chunks(store, doc_id, filename, batch)
+            chunk_count += len(batch)
+            batch = {}
+    if batch:
+        store_chunks(store, doc_id, filename, batch)
+        chunk_count += len(batch)
+
+    store.query(
+        """
+    MERGE (d:PdfDocument {id: $doc_id})
+    SET d.filename = $filename, d.chunks = $chunks, d.ingested_at = datetime()
+    """,
+        params={"doc_id": doc_id, "filename": filename, "chunks": chunk_count},
+    )
+    return doc_id
+
+
+def list_documents(store: Neo4jVector) -> list:
+    return store.query(
+        """
+    MATCH (d:PdfDocument)
+    RETURN d.id AS id, d.filename AS filename, d.chunks AS chunks
+    ORDER BY d.filename
+    """
+    )
+
+
+def evict_document(store: Neo4jVector, doc_id: str) -> None:
+    # Delete in slices so evicting a large document doesn't need one huge transaction
+    while store.query(
+        """
+    MATCH (c:PdfBotChunk {doc_id: $doc_id})
+    WITH c LIMIT 5000
+    DETACH DELETE c
+    RETURN count(*) AS deleted
+    """,
+        params={"doc_id": doc_id},
+    )[0]["deleted"]:
+        pass
+    store.query(
+        "MATCH (d:PdfDocument {id: $doc_id}) DETACH DELETE d",
+        params={"doc_id": doc_id},
+    )
 
-        chunks = text_splitter.split_text(text=text)
-        qa_prompt = ChatPromptTemplate.from_messages(
-            [
-                (
-                    "human",
-                    "Based on the provided summary: {summaries} \n Answer the following question:{question}",
-                )
-            ]
-        )
 
-        # Store the chunks part in db (vector)
-        vectorstore = Neo4jVector.from_texts(
-            chunks,
-            url=url,
-            username=username,
-            password=password,
-            embedding=embeddings,
-            index_name="pdf_bot",
-            node_label="PdfBotChunk",
-            pre_delete_collection=True,  # Delete existing PDF data
+def main():
+    st.header("📄Chat with your pdf files")
+    store = load_pdf_store(config_key)
+
+    # upload your pdf files
+    pdfs = st.file_uploader("Upload your PDFs", type="pdf", accept_multiple_files=True)
+
+    # Hash and ingest each upload once per session, not on every rerun.
+    # Uploads whose document was removed stay removed until uploaded again
+    ingested = st.session_state.setdefault("ingested_pdfs", {})
+    removed = st.session_state.setdefault("removed_pdfs", set())
+    for pdf in pdfs:
+        if pdf.file_id not in ingested and pdf.file_id not in removed:
+            with st.spinner(f"Reading {pdf.name}..."):
+                ingested[pdf.file_id] = ingest_pdf(store, pdf.getvalue(), pdf.name)
+
+    documents = list_documents(store)
+    if not documents:
+        return
+    filenames = {doc["id"]: doc["filename"] for doc in documents}
+
+    with st.sidebar:
+        st.title("Library")
+        st.caption(f"{len(documents)} documents")
+        evicted = st.selectbox(
+            "Remove a document", list(filenames), index=None, format_func=filenames.get
         )
-        qa = (
-            RunnableParallel(
-                {
-                    "summaries": vectorstore.as_retriever(search_kwargs={"k": 2})
-                    | format_docs,
-                    "question": RunnablePassthrough(),
-                }
+        if evicted and st.button("Remove", type="primary"):
+            evict_document(store, evicted)
+            removed.update(
+                file_id for file_id, doc_id in ingested.items() if doc_id == evicted
+            )
+            st.session_state["ingested_pdfs"] = {
+                file_id: doc_id
+                for file_id, doc_id in ingested.items()
+                if doc_id != evicted
+            }
+            st.rerun()
+
+    uploaded = [ingested[pdf.file_id] for pdf in pdfs if pdf.file_id in ingested]
+    selected = st.multiselect(
+        "Documents to search (none selected searches the whole library)",
+        list(filenames),
+        default=[doc_id for doc_id in uploaded if doc_id in filenames],
+        format_func=filenames.get,
+    )
+    search_kwargs = {"k": 2}
+    if selected:
+        # Restrict the similarity search to the chunks of the selected documents
+        search_kwargs["filter"] = {"doc_id": {"$in": selected}}
+
+    qa_prompt = ChatPromptTemplate.from_messages(
+        [
+            (
+                "human",
+                "Based on the provided summary: {summaries} \n Answer the following question:{question}",
             )
-            | qa_prompt
-            | llm
-            | StrOutputParser()
+        ]
+    )
+    qa = (
+        RunnableParallel(
+            {
+                "summaries": store.as_retriever(search_kwargs=search_kwargs)
+                | format_docs,
+                "question": RunnablePassthrough(),
+            }
         )
+        | qa_prompt
+        | registry.llm()
+        | StrOutputParser()
+    )
 
-        # Accept user questions/query
-        query = st.text_input("Ask questions about your PDF file")
+    # Accept user questions/query
+    query = st.text_input("Ask questions about your PDF files")
 
-        if query:
-            stream_handler = StreamHandler(st.empty())
-            qa.invoke(query, {"callbacks": [stream_handler]})
+    if query:
+        stream_handler = StreamHandler(st.empty())
+        qa.invoke(query, {"callbacks": [stream_handler]})
 
 
 if __name__ == "__main__":
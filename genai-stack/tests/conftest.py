@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The apps are flat modules next to this directory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
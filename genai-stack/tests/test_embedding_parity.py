@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("sentence_transformers")
+HuggingFaceEmbeddings = pytest.importorskip(
+    "langchain_huggingface"
+).HuggingFaceEmbeddings
+
+from chains import QuantizedSentenceTransformerEmbeddings
+
+MODEL = "all-MiniLM-L6-v2"
+
+TEXTS = [
+    "How do I create an index on a node property in Neo4j?",
+    "MATCH (p:Person)-[:KNOWS]->(f) RETURN f.name ORDER BY f.name LIMIT 10",
+    "Why does my Cypher query return duplicate rows after an OPTIONAL MATCH?",
+    "Connection refused when the Python driver connects to bolt://localhost:7687",
+    "What is the difference between MERGE and CREATE?",
+    "a",
+]
+
+
+def test_int8_embeddings_match_fp32():
+    # The int8 backend must be usable with a vector index built by the fp32 one
+    fp32 = np.asarray(HuggingFaceEmbeddings(model_name=MODEL).embed_documents(TEXTS))
+    int8 = np.asarray(
+        QuantizedSentenceTransformerEmbeddings(MODEL).embed_documents(TEXTS)
+    )
+
+    assert fp32.shape == int8.shape == (len(TEXTS), 384)
+    cosine = np.sum(fp32 * int8, axis=1) / (
+        np.linalg.norm(fp32, axis=1) * np.linalg.norm(int8, axis=1)
+    )
+    assert np.all(cosine >= 0.99), dict(zip(TEXTS, cosine.round(4)))
@@ -1,3 +1,17 @@
+import io
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PyPDF2 import PdfReader
+
+
 class BaseLogger:
     def __init__(self) -> None:
         self.info = print
@@ -12,9 +26,9 @@ def extract_title_and_question(input_string):
 
     for line in lines:
         if line.startswith("Title:"):
-            title = line.split("Title: ", 1)[1].strip()
+            title = line.split("Title:", 1)[1].strip()
         elif line.startswith("Question:"):
-            question = line.split("Question: ", 1)[1].strip()
+            question = line.split("Question:", 1)[1].strip()
             is_question = (
                 True  # set the flag to True once we encounter a "Question:" line
             )
@@ -23,9 +37,75 @@ def extract_title_and_question(input_string):
             # then it is a continuation of the question
             question += "\n" + line.strip()
 
+    # drop the closing "---" of the response template
+    question = re.sub(r"(\n-+)+$", "", question)
     return title, question
 
 
+class TicketStreamParser:
+    """Parses the "Title: ... Question: ..." ticket format while it streams.
+
+    `feed` takes the next chunk of LLM output and returns the new text of each
+    field as (field, text) pairs, field being "title" or "question", so both
+    can be shown from their first words on. Lines that could still turn out
+    to be a marker or the closing "---" are held back until they complete.
+    `result` parses the whole response with extract_title_and_question.
+    """
+
+    _markers = {"Title:": "title", "Question:": "question"}
+
+    def __init__(self):
+        self.text = ""
+        self._line = ""  # the incomplete last line
+        self._field = None  # field the current line is emitted to
+        self._sent = 0  # characters of the current line emitted so far
+        self._in_question = False
+        self._held = ""  # blank or "---" lines inside the question
+
+    def feed(self, chunk: str) -> list:
+        self.text += chunk
+        self._line += chunk
+        updates = []
+        while "\n" in self._line:
+            line, self._line = self._line.split("\n", 1)
+            self._parse(line, True, updates)
+            self._field = None
+            self._sent = 0
+        self._parse(self._line, False, updates)
+        return updates
+
+    def result(self) -> tuple:
+        return extract_title_and_question(self.text)
+
+    def _parse(self, line: str, complete: bool, updates: list) -> None:
+        if self._field is None:
+            marker = next((m for m in self._markers if line.startswith(m)), None)
+            if marker is not None:
+                self._field = self._markers[marker]
+                self._in_question = self._field == "question"
+                self._sent = len(marker)
+            elif not complete and any(m.startswith(line) for m in self._markers):
+                return
+            elif not self._in_question:
+                return
+            elif not line.strip().strip("-"):
+                if complete:
+                    self._held += "\n" + line.strip()
+                return
+            else:
+                self._field = "question"
+                updates.append(("question", self._held + "\n"))
+                self._held = ""
+        text = line[self._sent :]
+        if self._sent == 0 or line[: self._sent] in self._markers:
+            # a field starts after the marker, without the leading spaces
+            text = text.lstrip()
+            if not text:
+                return
+        updates.append((self._field, text))
+        self._sent = len(line)
+
+
 def create_vector_index(driver) -> None:
     index_query = "CREATE VECTOR INDEX stackoverflow IF NOT EXISTS FOR (m:Question) ON m.embedding"
     try:
@@ -41,6 +121,18 @@ def create_vector_index(driver) -> None:
         pass
 
 
+def create_fulltext_index(driver) -> None:
+    # Keyword companion of the vector index, used by hybrid retrieval
+    index_query = (
+        "CREATE FULLTEXT INDEX stackoverflow_fulltext IF NOT EXISTS "
+        "FOR (n:Question|Answer) ON EACH [n.title, n.body]"
+    )
+    try:
+        driver.query(index_query)
+    except:  # Already exists
+        pass
+
+
 def create_constraints(driver):
     driver.query(
         "CREATE CONSTRAINT question_id IF NOT EXISTS FOR (q:Question) REQUIRE (q.id) IS UNIQUE"
@@ -54,7 +146,317 @@ def create_constraints(driver):
     driver.query(
         "CREATE CONSTRAINT tag_name IF NOT EXISTS FOR (t:Tag) REQUIRE (t.name) IS UNIQUE"
     )
+    driver.query(
+        "CREATE CONSTRAINT import_state_tag IF NOT EXISTS FOR (s:ImportState) REQUIRE (s.tag) IS UNIQUE"
+    )
+    # Serves the top-scored example questions of generate_ticket
+    driver.query(
+        "CREATE RANGE INDEX question_score IF NOT EXISTS FOR (q:Question) ON (q.score)"
+    )
+
+
+def create_pdf_constraints(driver):
+    driver.query(
+        "CREATE CONSTRAINT pdf_chunk_id IF NOT EXISTS FOR (c:PdfBotChunk) REQUIRE (c.id) IS UNIQUE"
+    )
+    driver.query(
+        "CREATE CONSTRAINT pdf_document_id IF NOT EXISTS FOR (d:PdfDocument) REQUIRE (d.id) IS UNIQUE"
+    )
+    driver.query(
+        "CREATE INDEX pdf_chunk_doc_id IF NOT EXISTS FOR (c:PdfBotChunk) ON (c.doc_id)"
+    )
 
 
 def format_docs(docs):
     return "\n\n".join(doc.page_content for doc in docs)
+
+
+def _paragraphs(text: str) -> list:
+    return [p.strip() for p in re.split(r"\n\s*\n", text or "") if p.strip()]
+
+
+def truncate_to_tokens(text: str, max_tokens: int, count_tokens) -> tuple:
+    # Cut at a word boundary until the text (with a marker) fits the budget
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text, tokens
+    while text and tokens > max_tokens:
+        text = text[: max(int(len(text) * max_tokens / tokens * 0.9), 0)]
+        if " " in text:
+            text = text[: text.rindex(" ")]
+        tokens = count_tokens(text + " [...]") if text else 0
+    return (text + " [...]", tokens) if text else ("", 0)
+
+
+def build_context(docs, max_tokens: int, count_tokens) -> tuple:
+    """Renders retrieved questions and their answers into `max_tokens` tokens.
+
+    Documents come best last, as returned by the retrieval query. Paragraphs
+    are deduplicated best document first, so duplicated answers and quoted
+    snippets are only paid for once. The budget is then shared out evenly
+    over the question and answer bodies: short bodies are kept whole and
+    what they leave goes to the long ones, which are truncated. Documents
+    without structured metadata are treated as a single body.
+
+    Returns the context, best last, and its size in tokens.
+    """
+    seen = set()
+    pieces = []  # [doc rank, header, body, tokens needed]
+    for rank, doc in enumerate(reversed(docs)):
+        meta = doc.metadata
+        if "answers" in meta:
+            parts = [(f"##Question: {meta['title']}\n", meta["question"])] + [
+                (
+                    f"### Answer (Accepted: {answer['is_accepted']}"
+                    f" Score: {answer['score']}): ",
+                    answer["body"],
+                )
+                for answer in meta["answers"]
+            ]
+        else:
+            parts = [("", doc.page_content)]
+        for header, body in parts:
+            fresh = []
+            for paragraph in _paragraphs(body):
+                key = " ".join(paragraph.lower().split())
+                if key not in seen:
+                    seen.add(key)
+                    fresh.append(paragraph)
+            if fresh or header.startswith("##Question"):
+                body = "\n\n".join(fresh)
+                pieces.append([rank, header, body, count_tokens(header + body)])
+
+    # Water-filling: the smallest needs are met first at no more than a fair share
+    shares = {}
+    remaining = max_tokens
+    by_need = sorted(range(len(pieces)), key=lambda i: pieces[i][3])
+    for left, i in enumerate(by_need):
+        shares[i] = min(pieces[i][3], remaining // (len(pieces) - left))
+        remaining -= shares[i]
+
+    sections = {}
+    for i, (rank, header, body, _) in enumerate(pieces):
+        header_tokens = count_tokens(header) if header else 0
+        question = header.startswith("##Question")
+        if question and header_tokens > shares[i]:
+            # No room for the question itself, its answers would be orphans
+            sections[rank] = None
+            continue
+        text, _ = truncate_to_tokens(body, shares[i] - header_tokens, count_tokens)
+        # A question keeps its title even if its body is empty or deduplicated
+        if (text or question) and sections.get(rank, []) is not None:
+            sections.setdefault(rank, []).append(header + text)
+    context = "\n\n".join(
+        "\n".join(sections[rank])
+        for rank in sorted(sections, reverse=True)
+        if sections[rank]
+    )
+    return context, count_tokens(context) if context else 0
+
+
+_LUCENE_SPECIAL = re.compile(r'([+\-&|!(){}\[\]^"~*?:\\/])')
+_LUCENE_OPERATORS = re.compile(r"\b(AND|OR|NOT|TO)\b")
+
+
+def escape_lucene(text: str) -> str:
+    # Full-text queries are Lucene syntax; a question like "c++ || python?"
+    # must match literally instead of failing to parse
+    text = _LUCENE_SPECIAL.sub(r"\\\1", text)
+    return _LUCENE_OPERATORS.sub(lambda m: m.group(0).lower(), text)
+
+
+def bump_data_version(driver) -> None:
+    # Signals processes holding caches over the graph that new data was imported
+    driver.query(
+        "MERGE (v:DataVersion {name: 'stackoverflow'}) "
+        "SET v.version = coalesce(v.version, 0) + 1"
+    )
+
+
+def get_data_version(driver) -> int:
+    records = driver.query(
+        "MATCH (v:DataVersion {name: 'stackoverflow'}) RETURN v.version AS version"
+    )
+    return records[0]["version"] if records else 0
+
+
+def normalize_question(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class SemanticCache:
+    """In-process LRU cache keyed by normalized text.
+
+    When `similarity_threshold` and `embed` are given, a lookup that misses on
+    the exact key falls back to the most similar cached text by cosine
+    similarity of their embeddings. Entries expire after `ttl` seconds, and
+    the whole cache is cleared when `version()` changes; it is polled at most
+    every `version_check_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        max_size=1000,
+        ttl=None,
+        similarity_threshold=None,
+        embed=None,
+        version=None,
+        version_check_interval=30,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.embed = embed if similarity_threshold is not None else None
+        self.version = version
+        self.version_check_interval = version_check_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = 0.0
+
+    def _check_version(self) -> None:
+        now = time.monotonic()
+        if self.version is None or now - self._version_checked_at < (
+            self.version_check_interval
+        ):
+            return
+        self._version_checked_at = now
+        version = self.version()
+        if version != self._version:
+            self._version = version
+            self.clear()
+
+    def _expired(self, entry) -> bool:
+        return self.ttl is not None and time.monotonic() - entry[2] > self.ttl
+
+    def lookup(self, text: str, namespace: str = "", embedding=None):
+        """Returns (value, embedding); value is None on a miss.
+
+        `embedding` is the embedding of `text` if the caller already has it.
+        """
+        if not self.max_size:
+            return None, None
+        self._check_version()
+        key = (namespace, normalize_question(text))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], entry[1]
+        if self.embed is None:
+            self.misses += 1
+            return None, None
+
+        if embedding is None:
+            embedding = self.embed(text)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        embedding = embedding / (np.linalg.norm(embedding) or 1.0)
+        with self._lock:
+            candidates = [
+                (k, e)
+                for k, e in self._entries.items()
+                if k[0] == namespace and e[1] is not None and not self._expired(e)
+            ]
+            if candidates:
+                scores = np.stack([e[1] for _, e in candidates]) @ embedding
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity_threshold:
+                    best_key, best_entry = candidates[best]
+                    self._entries.move_to_end(best_key)
+                    self.hits += 1
+                    return best_entry[0], embedding
+            self.misses += 1
+        return None, embedding
+
+    def put(self, text: str, value, embedding=None, namespace: str = "") -> None:
+        if not self.max_size:
+            return
+        if embedding is None and self.embed is not None:
+            embedding = np.asarray(self.embed(text), dtype=np.float32)
+            embedding /= np.linalg.norm(embedding) or 1.0
+        key = (namespace, normalize_question(text))
+        with self._lock:
+            self._entries[key] = (value, embedding, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+# One extraction pool shared by every upload, created on first use
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+# In a worker: the PDF its latest page came from, read from disk on demand
+_pdf_file = None
+_pdf_reader = None
+
+
+def _get_pdf_pool(workers: int) -> ProcessPoolExecutor:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pdf_pool
+
+
+def _extract_pdf_page(path: str, index: int) -> tuple:
+    # Workers get the path of the PDF instead of a copy of it and reopen the
+    # file only when a page of another document arrives
+    global _pdf_file, _pdf_reader
+    if _pdf_file is None or _pdf_file.name != path:
+        if _pdf_file is not None:
+            _pdf_file.close()
+        _pdf_file = open(path, "rb")
+        _pdf_reader = PdfReader(_pdf_file)
+    return index + 1, _pdf_reader.pages[index].extract_text() or ""
+
+
+def extract_pdf_pages(data: bytes, workers: int = 4):
+    """Yields (page number, text) in page order.
+
+    Pages are extracted in a process pool shared by all calls, with at most
+    two pages per worker in flight. The PDF is written to a temporary file
+    that the workers read from, so it is not copied into every process.
+    """
+    reader = PdfReader(io.BytesIO(data))
+    page_count = len(reader.pages)
+    workers = min(workers, os.cpu_count() or 1)
+    if workers <= 1 or page_count <= 1:
+        for index, page in enumerate(reader.pages):
+            yield index + 1, page.extract_text() or ""
+        return
+
+    executor = _get_pdf_pool(workers)
+    pending = deque()
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as file:
+        file.write(data)
+        file.flush()
+        try:
+            next_index = 0
+            while next_index < page_count or pending:
+                while next_index < page_count and len(pending) < workers * 2:
+                    pending.append(
+                        executor.submit(_extract_pdf_page, file.name, next_index)
+                    )
+                    next_index += 1
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()